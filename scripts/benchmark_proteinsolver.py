@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Compare the speed and output of the original and the inference-only ProteinSolver models.
+
+Usage:
+    python scripts/benchmark_proteinsolver.py --num_residues 1000 --num_repeats 5
+"""
+
+import time
+
+import fire
+import numpy as np
+import torch
+
+from elaspic2.core import InferenceRuntime
+from elaspic2.plugins.proteinsolver import ProteinSolver
+from elaspic2.plugins.proteinsolver.protein_data import get_residue_distances
+
+MODEL_CONFIGS = {
+    "original": {"inference_model": False},
+    "inference": {"inference_model": True},
+    "inference (scripted)": {"inference_model": True, "script": True},
+}
+
+
+def make_graph(num_residues, seed=42):
+    """Create a random protein-like contact graph, with one atom per residue."""
+    rng = np.random.default_rng(seed)
+    coords = np.cumsum(rng.normal(scale=2.2, size=(num_residues, 3)), axis=0)
+    distances_df = get_residue_distances(coords, np.arange(num_residues), 12)
+    row = torch.tensor(distances_df["residue_idx_1"].values)
+    col = torch.tensor(distances_df["residue_idx_2"].values)
+    distances = torch.tensor(distances_df["distance"].values, dtype=torch.float)
+    edge_index = torch.stack([torch.cat([row, col]), torch.cat([col, row])])
+    edge_attr = torch.stack([1 / distances, torch.ones_like(distances)], dim=1).repeat(2, 1)
+    x = torch.from_numpy(rng.integers(0, 20, num_residues))
+    x[0] = 20
+    return x, edge_index, edge_attr
+
+
+def main(num_residues=1000, num_repeats=5, device="cpu"):
+    device = torch.device(device)
+    x, edge_index, edge_attr = (t.to(device) for t in make_graph(num_residues))
+    print(f"Number of residues: {num_residues}, number of edges: {edge_index.size(1)}")
+
+    output_ref = None
+    for name, config in MODEL_CONFIGS.items():
+        ProteinSolver.load_model(device=device, **config)
+        with InferenceRuntime.inference():
+            output = ProteinSolver.model(x, edge_index, edge_attr)
+            start_time = time.perf_counter()
+            for _ in range(num_repeats):
+                ProteinSolver.model(x, edge_index, edge_attr)
+            time_per_run = (time.perf_counter() - start_time) / num_repeats
+        if output_ref is None:
+            output_ref = output
+        max_diff = (output - output_ref).abs().max().item()
+        print(f"{name:<24} {time_per_run * 1000:10.1f} ms    max abs diff: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -80,17 +80,25 @@ def calculate_stability(model, protein_structure, protein_sequence, mutation_lis
         remove_hetatms=True,
     )
 
-    mutation_stability_features = list(
-        tqdm(
-            (model.analyze_mutation(mut, protein_stability_features) for mut in mutation_list),
-            total=len(mutation_list),
-            desc="stability",
-        )
+    mutation_stability_features = analyze_mutations(
+        model, mutation_list, protein_stability_features, desc="stability"
     )
 
     return mutation_stability_features
 
 
+def analyze_mutations(model, mutation_list, protein_features, desc, chunk_size=64):
+    # Mutations are passed to the model in chunks, so that model evaluations are batched
+    # while the progress bar is still updated
+    mutation_features = []
+    with tqdm(total=len(mutation_list), desc=desc) as progress:
+        for start in range(0, len(mutation_list), chunk_size):
+            mutation_chunk = mutation_list[start : start + chunk_size]
+            mutation_features.extend(model.analyze_mutations(mutation_chunk, protein_features))
+            progress.update(len(mutation_chunk))
+    return mutation_features
+
+
 def combine_results_core(model, mutation_list, mutation_stability_features):
     protbert_core_list = [
         f["protbert_core_score_wt"] - f["protbert_core_score_mut"]
@@ -141,12 +149,8 @@ def calculate_affinity(
         remove_hetatms=True,
     )
 
-    mutation_affinity_features = list(
-        tqdm(
-            (model.analyze_mutation(mut, protein_affinity_features) for mut in mutation_list),
-            total=len(mutation_list),
-            desc="affinity",
-        )
+    mutation_affinity_features = analyze_mutations(
+        model, mutation_list, protein_affinity_features, desc="affinity"
     )
 
     return mutation_affinity_features
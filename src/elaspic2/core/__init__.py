@@ -1 +1,4 @@
+from .cache import *
+from .inference import *
 from .interface import *
+from .weights import *
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache:
+    """Least-recently-used cache with a bounded total size.
+
+    Args:
+        maxsize: Maximum total size of all cached values.
+        getsizeof: Function returning the size of a cached value.
+            By default, every value has a size of one, so `maxsize` is the maximum number of
+            cached values.
+    """
+
+    def __init__(self, maxsize: int, getsizeof: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.getsizeof = getsizeof if getsizeof is not None else (lambda value: 1)
+        self.currsize = 0
+        # Cached values and their sizes, from least to most recently used
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.getsizeof(value)
+        if key in self._entries:
+            _, old_size = self._entries.pop(key)
+            self.currsize -= old_size
+        if size > self.maxsize:
+            # Value would evict everything else and still not fit
+            return
+        while self.currsize + size > self.maxsize:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.currsize -= evicted_size
+        self._entries[key] = (value, size)
+        self.currsize += size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.currsize = 0
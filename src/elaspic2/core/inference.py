@@ -0,0 +1,136 @@
+import logging
+import os
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+import torch
+
+__all__ = ["InferenceConfig", "InferenceRuntime"]
+
+logger = logging.getLogger(__name__)
+
+# `torch.inference_mode` is only available in PyTorch >= 1.9
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+class InferenceConfig(NamedTuple):
+    # Number of threads used to parallelize individual operations (intra-op parallelism).
+    num_threads: Optional[int] = None
+    # Number of threads used to run independent operations in parallel (inter-op parallelism).
+    num_interop_threads: Optional[int] = None
+    # CPUs that the current process should be pinned to.
+    cpu_affinity: Optional[Tuple[int, ...]] = None
+
+    @classmethod
+    def from_env(cls) -> "InferenceConfig":
+        """Read the configuration from environment variables.
+
+        The following environment variables are supported:
+
+        - `ELASPIC2_NUM_THREADS`: Number of intra-op threads.
+        - `ELASPIC2_NUM_INTEROP_THREADS`: Number of inter-op threads.
+        - `ELASPIC2_CPU_AFFINITY`: CPUs to pin the process to (e.g. "0-3,8").
+        """
+        num_threads = os.environ.get("ELASPIC2_NUM_THREADS")
+        num_interop_threads = os.environ.get("ELASPIC2_NUM_INTEROP_THREADS")
+        cpu_affinity = os.environ.get("ELASPIC2_CPU_AFFINITY")
+        return cls(
+            num_threads=int(num_threads) if num_threads else None,
+            num_interop_threads=int(num_interop_threads) if num_interop_threads else None,
+            cpu_affinity=parse_cpu_list(cpu_affinity) if cpu_affinity else None,
+        )
+
+    @classmethod
+    def for_worker(
+        cls, worker_idx: int, num_threads: int, num_interop_threads: int = 1
+    ) -> "InferenceConfig":
+        """Pin worker `worker_idx` to its own block of `num_threads` available CPUs.
+
+        This allows several workers to share a node without competing for the same cores.
+        If there are more workers than blocks of CPUs, blocks wrap around to the start of the
+        list of available CPUs, so every worker still gets `num_threads` CPUs.
+        """
+        available_cpus = sorted(_get_available_cpus())
+        if not 0 < num_threads <= len(available_cpus):
+            raise ValueError(
+                f"Cannot pin {num_threads} threads to {len(available_cpus)} available CPUs."
+            )
+        start = worker_idx * num_threads
+        cpu_affinity = tuple(
+            available_cpus[(start + i) % len(available_cpus)] for i in range(num_threads)
+        )
+        return cls(
+            num_threads=num_threads,
+            num_interop_threads=num_interop_threads,
+            cpu_affinity=cpu_affinity,
+        )
+
+
+class InferenceRuntime:
+    """Runtime shared by all plugins that run PyTorch models."""
+
+    config: InferenceConfig = InferenceConfig()
+    is_configured: bool = False
+
+    @classmethod
+    def configure(cls, config: Optional[InferenceConfig] = None) -> None:
+        """Apply thread settings and CPU affinity.
+
+        Args:
+            config: Configuration to apply. If not provided, the configuration is read from
+                environment variables (see `InferenceConfig.from_env`).
+        """
+        if config is None:
+            config = InferenceConfig.from_env()
+
+        num_threads = config.num_threads
+        if config.cpu_affinity is not None:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, config.cpu_affinity)
+            else:
+                logger.warning("Setting CPU affinity is not supported on this platform.")
+            if num_threads is None:
+                num_threads = len(config.cpu_affinity)
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        if config.num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(config.num_interop_threads)
+            except RuntimeError as e:
+                # Can only be set once, before any inter-op parallel work is started
+                logger.warning(f"Could not set the number of inter-op threads ({e}).")
+
+        cls.config = config
+        cls.is_configured = True
+
+    @classmethod
+    @contextmanager
+    def inference(cls) -> Iterator[None]:
+        """Context manager for running models without building any autograd state."""
+        if not cls.is_configured:
+            cls.configure()
+        with _inference_mode():
+            yield
+
+
+def parse_cpu_list(cpu_list: str) -> Tuple[int, ...]:
+    """Parse a list of CPUs in the format used by `taskset` (e.g. "0-3,8")."""
+    cpus = []
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return tuple(cpus)
+
+
+def _get_available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+    return range(os.cpu_count() or 1)
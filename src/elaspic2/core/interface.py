@@ -163,6 +163,10 @@ class MutationAnalyzer:
     def analyze_mutation(cls, mutation: str, data: ToolOutput) -> dict:
         raise NotImplementedError
 
+    @classmethod
+    def analyze_mutations(cls, mutations: List[str], data: ToolOutput) -> List[dict]:
+        return [cls.analyze_mutation(mutation, data) for mutation in mutations]
+
 
 class Mutator:
     @classmethod
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Type, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+__all__ = [
+    "save_weights",
+    "load_weights",
+    "load_weights_cached",
+    "assign_weights",
+    "skip_init_weights",
+]
+
+logger = logging.getLogger(__name__)
+
+# Offset of every tensor in the weight store is a multiple of this many bytes
+_ALIGNMENT = 64
+_MAGIC = b"EL2W"
+# Functions in `torch.nn.init` used by the `reset_parameters` methods of torch modules
+_INIT_FUNCTIONS = [
+    "uniform_",
+    "normal_",
+    "trunc_normal_",
+    "constant_",
+    "ones_",
+    "zeros_",
+    "eye_",
+    "dirac_",
+    "xavier_uniform_",
+    "xavier_normal_",
+    "kaiming_uniform_",
+    "kaiming_normal_",
+    "orthogonal_",
+    "sparse_",
+]
+
+
+def save_weights(state_dict: Dict[str, torch.Tensor], weights_file: Union[str, Path]) -> None:
+    """Save `state_dict` in a format that can be memory-mapped by `load_weights`.
+
+    The file consists of a header, describing the name, dtype, shape and offset of every tensor,
+    followed by the raw tensor data. Tensors that share storage (e.g. tied weights) are written
+    only once. The file is written atomically, so it is safe for several processes to
+    create the same file concurrently.
+    """
+    weights_file = Path(weights_file)
+
+    arrays = []
+    header: Dict[str, dict] = {}
+    names_by_data_ptr: Dict[tuple, str] = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tuple(tensor.shape), tensor.dtype)
+        if tensor.numel() and key in names_by_data_ptr:
+            header[name] = {"alias": names_by_data_ptr[key]}
+            continue
+        names_by_data_ptr[key] = name
+        array = tensor.detach().cpu().contiguous().numpy()
+        offset = _align(offset)
+        header[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(_MAGIC) + 8 + len(header_bytes))
+
+    weights_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=weights_file.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(_MAGIC)
+            fout.write(struct.pack("<Q", len(header_bytes)))
+            fout.write(header_bytes)
+            for array_offset, array in arrays:
+                fout.seek(data_start + array_offset)
+                fout.write(array.tobytes())
+        os.replace(temp_file, weights_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+def load_weights(weights_file: Union[str, Path]) -> Dict[str, torch.Tensor]:
+    """Memory-map a file written by `save_weights`.
+
+    The returned tensors are backed by a copy-on-write mapping of `weights_file`, so all
+    processes that load the same file share a single copy of the weights in the page cache.
+    """
+    weights_file = Path(weights_file)
+    with weights_file.open("rb") as fin:
+        if fin.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"Not a weight store: '{weights_file}'.")
+        (header_length,) = struct.unpack("<Q", fin.read(8))
+        header = json.loads(fin.read(header_length).decode("utf-8"))
+    data_start = _align(len(_MAGIC) + 8 + header_length)
+
+    buffer = np.memmap(weights_file, dtype=np.uint8, mode="c")
+    state_dict: Dict[str, torch.Tensor] = {}
+    for name, info in header.items():
+        if "alias" in info:
+            continue
+        dtype = np.dtype(info["dtype"])
+        array = np.ndarray(
+            info["shape"], dtype=dtype, buffer=buffer, offset=data_start + info["offset"]
+        )
+        state_dict[name] = torch.from_numpy(array)
+    for name, info in header.items():
+        if "alias" in info:
+            state_dict[name] = state_dict[info["alias"]]
+    return state_dict
+
+
+def load_weights_cached(
+    source_file: Union[str, Path], load_state_dict: Callable[[], Dict[str, torch.Tensor]]
+) -> Dict[str, torch.Tensor]:
+    """Memory-map the weights stored in `source_file`, converting them on first use.
+
+    Args:
+        source_file: File containing the original weights.
+        load_state_dict: Function returning the state dict stored in `source_file`.
+            Only called if the converted weights are missing or older than `source_file`.
+    """
+    source_file = Path(source_file)
+    weights_file = _get_weights_file(source_file)
+    if not weights_file.is_file() or weights_file.stat().st_mtime < source_file.stat().st_mtime:
+        logger.info(f"Converting '{source_file}' into a memory-mappable weight store...")
+        save_weights(load_state_dict(), weights_file)
+    return load_weights(weights_file)
+
+
+def assign_weights(module: nn.Module, state_dict: Dict[str, torch.Tensor]) -> None:
+    """Make the parameters and buffers of `module` point to the tensors in `state_dict`.
+
+    Unlike `module.load_state_dict`, this does not copy the data, so memory-mapped weights
+    remain shared between processes.
+    """
+    parameter_names = {name for name, _ in module.named_parameters()}
+    missing_keys = parameter_names - set(state_dict)
+    if missing_keys:
+        raise KeyError(f"Missing weights for parameters: {sorted(missing_keys)}.")
+
+    # Tied weights refer to the same tensor in `state_dict` and should share one parameter
+    parameters_by_tensor_id: Dict[int, nn.Parameter] = {}
+    for name, tensor in state_dict.items():
+        module_name, _, attr_name = name.rpartition(".")
+        submodule = module
+        for part in module_name.split(".") if module_name else []:
+            submodule = getattr(submodule, part)
+        if attr_name in submodule._parameters:
+            if id(tensor) not in parameters_by_tensor_id:
+                parameters_by_tensor_id[id(tensor)] = nn.Parameter(tensor, requires_grad=False)
+            submodule._parameters[attr_name] = parameters_by_tensor_id[id(tensor)]
+        elif attr_name in submodule._buffers:
+            submodule._buffers[attr_name] = tensor
+        else:
+            raise KeyError(f"Unexpected weights: '{name}'.")
+
+
+@contextmanager
+def skip_init_weights(*module_types: Type[nn.Module]) -> Iterator[None]:
+    """Skip the random initialization of the weights of modules created in this context.
+
+    Use this to create a module whose weights are replaced by `assign_weights` right away.
+    The parameters of the module are allocated but never written to, so they do not take up
+    any physical memory before they are replaced.
+
+    Args:
+        module_types: Classes whose `_init_weights` method should also be skipped.
+            `transformers` models initialize their weights using this method.
+    """
+    init_functions = {
+        name: getattr(nn.init, name) for name in _INIT_FUNCTIONS if hasattr(nn.init, name)
+    }
+    # `None` if the method is inherited, in which case it is deleted again on exit
+    init_methods = {
+        module_type: vars(module_type).get("_init_weights") for module_type in module_types
+    }
+    try:
+        for name in init_functions:
+            setattr(nn.init, name, _skip_init_function)
+        for module_type in module_types:
+            module_type._init_weights = _skip_init_method  # type: ignore
+        yield
+    finally:
+        for name, init_function in init_functions.items():
+            setattr(nn.init, name, init_function)
+        for module_type, init_method in init_methods.items():
+            if init_method is None:
+                del module_type._init_weights  # type: ignore
+            else:
+                module_type._init_weights = init_method  # type: ignore
+
+
+def _skip_init_function(tensor: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+    return tensor
+
+
+def _skip_init_method(self, module: nn.Module) -> None:
+    pass
+
+
+def _get_weights_file(source_file: Path) -> Path:
+    weights_file = source_file.with_suffix(".weights")
+    if weights_file.is_file() or os.access(source_file.parent, os.W_OK):
+        return weights_file
+    # Package data directory is read-only, so store converted weights in the user cache instead
+    source_hash = hashlib.md5(source_file.resolve().as_posix().encode("utf-8")).hexdigest()
+    return Path.home().joinpath(
+        ".cache", "elaspic2", f"{source_file.stem}-{source_hash[:8]}.weights"
+    )
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
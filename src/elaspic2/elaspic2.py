@@ -1,18 +1,23 @@
+import functools
+import itertools
 import json
 import tempfile
+import warnings
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Union
 
 import lightgbm as lgb
 import numpy as np
-import pandas as pd
 import torch
 from kmbio import PDB
 from kmtools import structure_tools
+from sklearn.decomposition import PCA
 
 import elaspic2.data
+from elaspic2.core import InferenceConfig, InferenceRuntime
 from elaspic2.plugins.protbert import ProtBert
 from elaspic2.plugins.proteinsolver import ProteinSolver
+from elaspic2.prediction import FeatureColumns, FeatureDeltaPlan, LightGBMEnsemble, PCAProjection
 from elaspic2.types import COI, ELASPIC2Data
 from elaspic2.utils import guess_domain_defs
 
@@ -23,58 +28,100 @@ except ImportError:
 
 
 class ELASPIC2:
-    def __init__(self, device: torch.device = torch.device("cpu")):
+    def __init__(
+        self,
+        device: torch.device = torch.device("cpu"),
+        inference_config: Optional[InferenceConfig] = None,
+        mmap_weights: bool = False,
+    ):
+        """
+        Args:
+            device: Device on which the models should be evaluated.
+            inference_config: Thread and CPU affinity settings shared by all models.
+            mmap_weights: Whether to memory-map model weights, so that several workers on the same
+                node share a single copy of the weights (CPU only). Models are shared by all
+                instances of this class, so this has no effect on models that are already loaded.
+        """
         self.device = device
 
-        self.pca_columns = self._load_pca_columns()
-        self.pca_models = self._load_pca_models()
+        if inference_config is not None or not InferenceRuntime.is_configured:
+            InferenceRuntime.configure(inference_config)
 
-        self.lgb_columns = self._load_lgb_columns()
-        self.lgb_models = self._load_lgb_models()
+        if mmap_weights and (ProtBert.is_loaded or ProteinSolver.is_loaded):
+            warnings.warn(
+                "ProtBert and / or ProteinSolver are already loaded, so `mmap_weights` is ignored "
+                "for them. Call their `load_model(mmap_weights=True)` methods to reload them."
+            )
 
         if not ProtBert.is_loaded:
-            ProtBert.load_model(device=device)
+            ProtBert.load_model(device=device, mmap_weights=mmap_weights)
 
         if not ProteinSolver.is_loaded:
-            ProteinSolver.load_model(device=device)
+            ProteinSolver.load_model(device=device, mmap_weights=mmap_weights)
 
+    # PCA and LightGBM models are loaded the first time that they are needed for a given COI,
+    # and are shared by all instances of this class
     @staticmethod
-    def _load_pca_models():
-        pca_models = {COI.CORE: {}, COI.INTERFACE: {}}
+    @functools.lru_cache(maxsize=None)
+    def _load_pca_models(coi: COI) -> Dict[str, PCA]:
+        pca_models = {}
         with importlib_resources.path(elaspic2.data, "pca") as pca_data_path:
-            for pca_file in sorted(pca_data_path.glob("*.pickle")):
-                coi = COI.CORE if "-core" in pca_file.name else COI.INTERFACE
-                pca_models[coi][pca_file.stem] = torch.load(pca_file)
+            for pca_file in sorted(pca_data_path.glob(f"*-{coi.value}.pickle")):
+                pca_models[pca_file.stem] = torch.load(pca_file)
         return pca_models
 
     @staticmethod
-    def _load_lgb_models():
-        lgb_models = {COI.CORE: [], COI.INTERFACE: []}
+    @functools.lru_cache(maxsize=None)
+    def _load_lgb_models(coi: COI) -> List[lgb.Booster]:
+        lgb_models = []
         with importlib_resources.path(elaspic2.data, "lgb") as lgb_data_path:
-            for lgb_file in sorted(lgb_data_path.glob("*.txt")):
-                coi = COI.CORE if "-core" in lgb_file.name else COI.INTERFACE
-                lgb_models[coi].append(lgb.Booster(model_file=lgb_file.as_posix()))
+            for lgb_file in sorted(lgb_data_path.glob(f"lgb-model-{coi.value}-*.txt")):
+                lgb_models.append(lgb.Booster(model_file=lgb_file.as_posix()))
         return lgb_models
 
     @staticmethod
-    def _load_pca_columns():
-        pca_columns = {}
-        with importlib_resources.path(elaspic2.data, "pca") as lgb_data_path:
-            for coi in COI:
-                json_file = lgb_data_path.joinpath(f"pca-columns-{coi.value}.json")
-                with json_file.open("rt") as fin:
-                    pca_columns[coi] = json.load(fin)
-        return pca_columns
+    @functools.lru_cache(maxsize=None)
+    def _load_pca_projection(coi: COI) -> PCAProjection:
+        pca_models = ELASPIC2._load_pca_models(coi)
+        return PCAProjection(
+            {
+                column: pca_models[f"pca-{column}-{coi.value}"]
+                for column in ELASPIC2._load_pca_columns(coi)
+            },
+            ELASPIC2._load_lgb_ensemble(coi).feature_names,
+        )
 
     @staticmethod
-    def _load_lgb_columns():
-        feature_columns = {}
-        with importlib_resources.path(elaspic2.data, "lgb") as lgb_data_path:
-            for coi in COI:
-                json_file = lgb_data_path.joinpath(f"feature-columns-{coi.value}.json")
-                with json_file.open("rt") as fin:
-                    feature_columns[coi] = json.load(fin)
-        return feature_columns
+    @functools.lru_cache(maxsize=None)
+    def _load_feature_delta_plan(coi: COI) -> FeatureDeltaPlan:
+        pca_projection = ELASPIC2._load_pca_projection(coi)
+        return FeatureDeltaPlan(
+            [
+                column
+                for column in ELASPIC2._load_lgb_ensemble(coi).feature_names
+                if not column.endswith("_pc")
+            ]
+            + pca_projection.columns
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _load_input_columns(coi: COI) -> FrozenSet[str]:
+        """Return the features that are used by the models, directly or through differences."""
+        return frozenset(ELASPIC2._load_feature_delta_plan(coi).input_columns)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _load_lgb_ensemble(coi: COI) -> LightGBMEnsemble:
+        return LightGBMEnsemble(ELASPIC2._load_lgb_models(coi))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _load_pca_columns(coi: COI) -> List[str]:
+        with importlib_resources.path(elaspic2.data, "pca") as pca_data_path:
+            json_file = pca_data_path.joinpath(f"pca-columns-{coi.value}.json")
+            with json_file.open("rt") as fin:
+                return json.load(fin)
 
     def build(
         self,
@@ -82,6 +129,8 @@ class ELASPIC2:
         protein_sequence: str,
         ligand_sequence: Optional[str],
         remove_hetatms=True,
+        protbert_window_size: Optional[int] = None,
+        protbert_ligand_window_size: Optional[int] = None,
     ) -> ELASPIC2Data:
         structure = PDB.load(structure_file)
         protein_domain_def, ligand_domain_def = guess_domain_defs(
@@ -105,7 +154,13 @@ class ELASPIC2:
 
         with tempfile.NamedTemporaryFile(suffix=".pdb") as pdb_file_obj:
             PDB.save(structure_new, pdb_file_obj.name)
-            protbert_data = ProtBert.build(protein_sequence, ligand_sequence, remove_hetatms)
+            protbert_data = ProtBert.build(
+                protein_sequence,
+                ligand_sequence,
+                remove_hetatms,
+                window_size=protbert_window_size,
+                ligand_window_size=protbert_ligand_window_size,
+            )
             proteinsolver_data = ProteinSolver.build(
                 pdb_file_obj.name, protein_sequence, ligand_sequence, remove_hetatms
             )
@@ -114,91 +169,143 @@ class ELASPIC2:
         return data
 
     def analyze_mutation(self, mutation: str, data: ELASPIC2Data) -> Dict:
-        if "_" not in mutation:
-            mutation = f"A_{mutation}"
+        return self.analyze_mutations([mutation], data)[0]
+
+    def analyze_mutations(
+        self, mutations: List[str], data: ELASPIC2Data, batch_size: Optional[int] = None
+    ) -> List[Dict]:
+        """Analyze multiple mutations in the same protein, batching model evaluations.
+
+        Args:
+            mutations: Mutations to analyze.
+            data: Output of `build`.
+            batch_size: Maximum number of sequences (ProtBert) or masked copies of the graph
+                (ProteinSolver) to evaluate in a single forward pass. Larger batches are faster,
+                but peak memory grows linearly with the batch size: for large complexes, each
+                ProteinSolver batch holds `batch_size` copies of the whole graph. If not
+                provided, each model uses its own default, which evaluates one copy of the
+                graph at a time.
+        """
+        mutations = [mutation if "_" in mutation else f"A_{mutation}" for mutation in mutations]
 
         coi = COI.INTERFACE if data.is_interface else COI.CORE
-        protbert_result = ProtBert.analyze_mutation(mutation, data.protbert_data)
-        proteinsolver_result = ProteinSolver.analyze_mutation(mutation, data.proteinsolver_data)
-        return {
-            **{f"protbert_{coi.value}_{key}": value for key, value in protbert_result.items()},
-            **{
-                f"proteinsolver_{coi.value}_{key}": value
-                for key, value in proteinsolver_result.items()
-            },
-        }
+        batch_kwargs = {} if batch_size is None else {"batch_size": batch_size}
+        protbert_results = ProtBert.analyze_mutations(mutations, data.protbert_data, **batch_kwargs)
+        proteinsolver_results = ProteinSolver.analyze_mutations(
+            mutations, data.proteinsolver_data, **batch_kwargs
+        )
+        return [
+            {
+                **{f"protbert_{coi.value}_{key}": value for key, value in protbert_result.items()},
+                **{
+                    f"proteinsolver_{coi.value}_{key}": value
+                    for key, value in proteinsolver_result.items()
+                },
+            }
+            for protbert_result, proteinsolver_result in zip(
+                protbert_results, proteinsolver_results
+            )
+        ]
 
     def predict_mutation_effect(
         self,
-        mutation_stability_features: List[Dict],
-        mutation_affinity_features: Optional[List[Dict]] = None,
+        mutation_stability_features: Union[List[Dict], FeatureColumns],
+        mutation_affinity_features: Optional[Union[List[Dict], FeatureColumns]] = None,
     ) -> np.ndarray:
+        """Predict the effect of mutations on protein stability or, if provided with affinity
+        features, on protein-protein interaction.
+
+        Args:
+            mutation_stability_features: Output of `analyze_mutation` for every mutation,
+                evaluated in the structure of the protein alone.
+            mutation_affinity_features: Output of `analyze_mutation` for every mutation,
+                evaluated in the structure of the protein in complex with the ligand.
+
+        Keys of the feature dictionaries that are not used by the models are ignored.
+        """
         coi = COI.INTERFACE if mutation_affinity_features is not None else COI.CORE
-        pca_models = self.pca_models[coi]
-        lgb_models = self.lgb_models[coi]
-        feature_columns = self.lgb_columns[coi]
+        input_columns = self._load_input_columns(coi)
+        if not isinstance(mutation_stability_features, FeatureColumns):
+            mutation_stability_features = FeatureColumns.from_records(
+                mutation_stability_features, input_columns
+            )
+        if mutation_affinity_features is not None and not isinstance(
+            mutation_affinity_features, FeatureColumns
+        ):
+            mutation_affinity_features = FeatureColumns.from_records(
+                mutation_affinity_features, input_columns
+            )
+        return self._predict(mutation_stability_features, mutation_affinity_features)
+
+    def predict_mutation_effect_chunks(
+        self,
+        mutation_stability_features: Iterable[Union[Dict, FeatureColumns]],
+        mutation_affinity_features: Optional[Iterable[Union[Dict, FeatureColumns]]] = None,
+        chunk_size: int = 4096,
+    ) -> Iterator[np.ndarray]:
+        """Predict the effect of a stream of mutations, one chunk at a time.
+
+        Only one chunk of features is held in memory at a time, so this can be used to annotate
+        any number of mutations.
+
+        Args:
+            mutation_stability_features: Iterable of `analyze_mutation` outputs and / or
+                `FeatureColumns`, evaluated in the structure of the protein alone.
+            mutation_affinity_features: Iterable of `analyze_mutation` outputs and / or
+                `FeatureColumns`, evaluated in the structure of the protein in complex with
+                the ligand. Must be chunked in the same way as `mutation_stability_features`.
+            chunk_size: Maximum number of feature records that are evaluated at once.
+
+        Yields:
+            Predictions for every chunk of mutations.
+        """
+        coi = COI.INTERFACE if mutation_affinity_features is not None else COI.CORE
+        input_columns = self._load_input_columns(coi)
+        stability_chunks = FeatureColumns.iter_chunks(
+            mutation_stability_features, chunk_size, input_columns
+        )
+        if mutation_affinity_features is None:
+            for stability_chunk in stability_chunks:
+                yield self._predict(stability_chunk, None)
+            return
+
+        affinity_chunks = FeatureColumns.iter_chunks(
+            mutation_affinity_features, chunk_size, input_columns
+        )
+        for stability_chunk, affinity_chunk in itertools.zip_longest(
+            stability_chunks, affinity_chunks
+        ):
+            if (
+                stability_chunk is None
+                or affinity_chunk is None
+                or stability_chunk.num_rows != affinity_chunk.num_rows
+            ):
+                raise ValueError("Stability and affinity features must be chunked in the same way.")
+            yield self._predict(stability_chunk, affinity_chunk)
+
+    def _predict(
+        self,
+        mutation_stability_features: FeatureColumns,
+        mutation_affinity_features: Optional[FeatureColumns],
+    ) -> np.ndarray:
+        coi = COI.INTERFACE if mutation_affinity_features is not None else COI.CORE
+        feature_delta_plan = self._load_feature_delta_plan(coi)
+        pca_projection = self._load_pca_projection(coi)
+        lgb_ensemble = self._load_lgb_ensemble(coi)
 
         if mutation_affinity_features is None:
             mutation_features = mutation_stability_features
         else:
-            mutation_features = [
-                {**stability_features, **affinity_features}
-                for stability_features, affinity_features in zip(
-                    mutation_stability_features, mutation_affinity_features
-                )
-            ]
-
-        mutation_features_df = pd.DataFrame(mutation_features)
-        mutation_features_df, pca_columns = self._add_feature_deltas(mutation_features_df)
-
-        n_components = 10
-        for split_idx, lgb_model in enumerate(lgb_models):
-            for column in pca_columns:
-                pca_model = pca_models[f"pca-{column}-{coi.value}"]
-                values = np.vstack(mutation_features_df[column].values)
-                values_out = pca_model.transform(values)
-                for i in range(n_components):
-                    new_column = f"{column}_{i}_pc"
-                    mutation_features_df[new_column] = values_out[:, i]
-
-            mutation_features_df[f"ddg_pred_{split_idx}"] = lgb_model.predict(
-                mutation_features_df[feature_columns]
+            mutation_features = FeatureColumns(
+                {**mutation_stability_features, **mutation_affinity_features}
             )
 
-        mutation_features_df["ddg_pred"] = mutation_features_df[
-            [f"ddg_pred_{split_idx}" for split_idx in range(len(lgb_models))]
-        ].mean(axis=1)
+        mutation_features = feature_delta_plan.apply(mutation_features)
 
-        return mutation_features_df["ddg_pred"].values
+        # Principal components do not depend on the LightGBM model, so they are calculated once
+        mutation_features.update(pca_projection.transform(mutation_features))
 
-    @staticmethod
-    def _add_feature_deltas(input_df):
-        def assign_delta(input_df, column, column_ref, column_change):
-            value_sample = input_df[column].iloc[0]
-            if isinstance(value_sample, (list, np.ndarray)):
-                input_df[column_change] = input_df[column].apply(np.array) - input_df[
-                    column_ref
-                ].apply(np.array)
-                return input_df, True
-            else:
-                input_df[column_change] = input_df[column] - input_df[column_ref]
-                return input_df, False
-
-        pca_columns = []
-        for column in sorted(input_df):
-            if column.endswith("_mut") and "_core2interface_" not in column:
-                column_ref = column[:-4] + "_wt"
-                column_change = column[:-4] + "_change"
-                input_df, is_array = assign_delta(input_df, column, column_ref, column_change)
-                if is_array:
-                    pca_columns.extend([column_ref, column_change])
-
-        for column in sorted(input_df):
-            if "_interface_" in column and not column.endswith("_mut"):
-                column_ref = column.replace("_interface_", "_core_")
-                column_change = column.replace("_interface_", "_core2interface_")
-                input_df, is_array = assign_delta(input_df, column, column_ref, column_change)
-                if is_array:
-                    pca_columns.extend([column_change])
-
-        return input_df, pca_columns
+        # LightGBM compares features to thresholds in double precision
+        # Columns are taken from the models themselves, so that they are always in the same order
+        feature_matrix = mutation_features.to_matrix(lgb_ensemble.feature_names, dtype=np.float64)
+        return lgb_ensemble.predict(feature_matrix)
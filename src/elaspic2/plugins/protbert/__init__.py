@@ -1,2 +1,3 @@
 from .types import ProtBertData
 from .protbert import ProtBert, ProtBertAnalyzeError, ProtBertBuildError
+from .scheduler import ProtBertBatchScheduler
@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Optional, Union
+
+import torch
+import torch.nn as nn
+
+
+class ProtBertBackend:
+    """Runs the ProtBert encoder and language model head on tokenized sequences."""
+
+    model: nn.Module
+
+    def encode(
+        self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Return hidden states of the last encoder layer."""
+        raise NotImplementedError
+
+    def lm_head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Return token logits for hidden states of shape `[..., hidden_size]`."""
+        raise NotImplementedError
+
+
+class TransformersBackend(ProtBertBackend):
+    """Eager backend that uses a `transformers.BertForMaskedLM` model."""
+
+    def __init__(self, model: nn.Module):
+        import transformers
+
+        self.model = model
+        self.transformers_major_version = int(transformers.__version__.split(".")[0])
+
+    def encode(
+        self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        kwargs = {"return_dict": False} if self.transformers_major_version >= 4 else {}
+        return self.model.bert(input_ids=input_ids, attention_mask=attention_mask, **kwargs)[0]
+
+    def lm_head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.model.cls(hidden_states)
+
+    def export(self, model_file: Union[str, Path], example_input_ids: torch.Tensor) -> None:
+        """Export the encoder and language model head as a TorchScript graph.
+
+        The exported graph can be loaded using `TorchScriptBackend.load` without importing
+        `transformers`.
+
+        Args:
+            model_file: File where the graph should be saved.
+            example_input_ids: Input used to trace the model.
+        """
+        example_attention_mask = torch.ones_like(example_input_ids)
+        with torch.no_grad():
+            encoder = torch.jit.trace(
+                _BertEncoder(self.model.bert, self.transformers_major_version),
+                (example_input_ids, example_attention_mask),
+                check_trace=False,
+            )
+            example_hidden_states = encoder(example_input_ids, example_attention_mask)
+            # The language model head is applied to the hidden states of selected tokens only
+            lm_head = torch.jit.trace(self.model.cls, (example_hidden_states[:, 0],))
+        graph = torch.jit.script(_ProtBertGraph(encoder, lm_head))
+        torch.jit.save(graph, Path(model_file).as_posix())
+
+
+class TorchScriptBackend(ProtBertBackend):
+    """Backend that uses a static graph exported using `TransformersBackend.export`."""
+
+    def __init__(self, model: torch.jit.ScriptModule):
+        self.model = model
+
+    @classmethod
+    def load(
+        cls, model_file: Union[str, Path], device: torch.device = torch.device("cpu")
+    ) -> "TorchScriptBackend":
+        model = torch.jit.load(Path(model_file).as_posix(), map_location=device)
+        return cls(model.eval())
+
+    def encode(
+        self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return self.model.encode(input_ids, attention_mask)
+
+    def lm_head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.model.lm_head(hidden_states)
+
+
+class _BertEncoder(nn.Module):
+    def __init__(self, bert: nn.Module, transformers_major_version: int):
+        super().__init__()
+        self.bert = bert
+        self.transformers_major_version = transformers_major_version
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        kwargs = {"return_dict": False} if self.transformers_major_version >= 4 else {}
+        return self.bert(input_ids=input_ids, attention_mask=attention_mask, **kwargs)[0]
+
+
+class _ProtBertGraph(nn.Module):
+    def __init__(self, encoder: nn.Module, lm_head: nn.Module):
+        super().__init__()
+        self.encoder = encoder
+        self.head = lm_head
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        hidden_states = self.encoder(input_ids, attention_mask)
+        return hidden_states, self.head(hidden_states)
+
+    @torch.jit.export
+    def encode(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.encoder(input_ids, attention_mask)
+
+    @torch.jit.export
+    def lm_head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.head(hidden_states)
@@ -1,14 +1,31 @@
+import functools
+import hashlib
 import logging
 import urllib.request
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from kmtools.structure_tools.types import DomainMutation as Mutation
 
 import elaspic2.plugins.protbert.data
-from elaspic2.core import MutationAnalyzer, SequenceTool
+from elaspic2.core import (
+    InferenceRuntime,
+    LRUCache,
+    MutationAnalyzer,
+    SequenceTool,
+    assign_weights,
+    load_weights_cached,
+    skip_init_weights,
+)
+from elaspic2.plugins.protbert.backends import (
+    ProtBertBackend,
+    TorchScriptBackend,
+    TransformersBackend,
+)
+from elaspic2.plugins.protbert.tokenizer import ProtBertTokenizer
 from elaspic2.plugins.protbert.types import ProtBertData
 
 try:
@@ -18,19 +35,127 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Approximate number of bytes used by a `score_cache` entry in addition to the probabilities:
+# the NumPy array object, the `(digest, index)` key and the entry in the `OrderedDict`
+_SCORE_CACHE_ENTRY_OVERHEAD = 512
+
+# Function evaluating the model on a list of token ids and, optionally, the position in every
+# sequence at which token logits are required. Yields the indices of the sequences in every
+# batch, their hidden states, padded to the length of the longest sequence in the batch, and,
+# if positions were provided, the token logits at those positions.
+BatchRunner = Callable[
+    [List[torch.Tensor], Optional[List[int]]],
+    Iterator[Tuple[List[int], torch.Tensor, Optional[torch.Tensor]]],
+]
+
 
 class ProtBert(SequenceTool, MutationAnalyzer):
-    transformers_major_version: int = None  # type: ignore
-    tokenizer = None
+    tokenizer: Optional[ProtBertTokenizer] = None
+    backend: Optional[ProtBertBackend] = None
+    # Model evaluated by `backend`. With the "transformers" backend, this is a single
+    # `BertForMaskedLM` instance: `model.bert` provides hidden states for features
+    # and `model.cls` turns them into logits for scores
     model = None
-    model_lm = None
     device = None
     is_loaded: bool = False
+    # Masked language model probabilities, keyed by a digest of the sequence and the masked
+    # position, and stored as float32 arrays. The size of an entry includes an estimate of the
+    # memory used by the array object, its key and its slot in the cache, so that the cache
+    # takes up at most about 64 MiB.
+    score_cache: LRUCache = LRUCache(
+        maxsize=2**26, getsizeof=lambda probas: probas.nbytes + _SCORE_CACHE_ENTRY_OVERHEAD
+    )
+    # Wild-type hidden states, keyed by sequence and capped at 1 GiB.
+    wt_features_cache: LRUCache = LRUCache(
+        maxsize=2**30, getsizeof=lambda tensors: sum(_get_nbytes(t) for t in tensors)
+    )
+    # Token ids of full sequences, keyed by sequence and capped at 64 MiB. Token ids are derived
+    # from `ProtBertData.sequence` every time they are needed, so they always match the sequence.
+    input_ids_cache: LRUCache = LRUCache(
+        maxsize=2**26, getsizeof=lambda input_ids: _get_nbytes(input_ids)
+    )
 
     @classmethod
-    def load_model(cls, model_name="prot_bert_bfd", device=torch.device("cpu")) -> None:
-        import transformers
-        from transformers import BertForMaskedLM, BertModel, BertTokenizer, logging
+    def load_model(
+        cls,
+        model_name="prot_bert_bfd",
+        device=torch.device("cpu"),
+        precision: str = "fp32",
+        backend: str = "transformers",
+        model_file: Optional[Union[str, Path]] = None,
+        mmap_weights: bool = False,
+    ) -> None:
+        """Load the ProtBert model.
+
+        Args:
+            model_name: Name of the model to load.
+            device: Device on which the model should be evaluated.
+            precision: Precision of the model weights.
+                Use "fp32" for full precision, "bf16" for bfloat16 weights, or "int8" for dynamic
+                int8 quantization of all linear layers (CPU only). Reduced precision speeds up
+                inference at the cost of a small drift in scores and features. "bf16" requires
+                a version of torch which implements bfloat16 matrix multiplications on `device`,
+                which, on CPU, is not the case for older versions.
+            backend: Backend used to evaluate the model.
+                Use "transformers" to evaluate the `transformers` model in eager mode, or
+                "torchscript" to load a static graph created using `ProtBert.export_model`.
+                The "torchscript" backend does not import `transformers`.
+            model_file: File containing the static graph, required by the "torchscript" backend.
+            mmap_weights: Whether to memory-map the model weights instead of reading them into
+                memory. Workers on the same node then share a single copy of the weights.
+                The weights are converted into a memory-mappable format the first time
+                this is used. Only supported by the "transformers" backend, for "fp32" models
+                on CPU.
+        """
+        if precision not in ["fp32", "bf16", "int8"]:
+            raise ValueError(f"Unsupported precision: {precision!r}.")
+        if precision == "int8" and device.type != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU.")
+        if precision == "bf16" and not _is_bf16_matmul_supported(device):
+            raise ValueError(
+                f"This version of torch does not support bfloat16 matrix multiplications on "
+                f"{device}."
+            )
+        if backend not in ["transformers", "torchscript"]:
+            raise ValueError(f"Unsupported backend: {backend!r}.")
+        if backend == "torchscript":
+            if model_file is None:
+                raise ValueError("The 'torchscript' backend requires a `model_file`.")
+            if precision != "fp32":
+                raise ValueError(
+                    "The precision of a TorchScript model is fixed when it is exported."
+                )
+        if mmap_weights and (backend != "transformers" or precision != "fp32"):
+            raise ValueError(
+                "Memory-mapped weights are only supported by 'fp32' 'transformers' models."
+            )
+        if mmap_weights and device.type != "cpu":
+            raise ValueError("Memory-mapped weights are only supported on CPU.")
+
+        if not InferenceRuntime.is_configured:
+            InferenceRuntime.configure()
+
+        with importlib_resources.path(elaspic2.plugins.protbert.data, "prot_bert_bfd") as data_dir:
+            cls.tokenizer = ProtBertTokenizer(data_dir.joinpath("vocab.txt"))
+            if backend == "transformers":
+                cls._download_model_data(data_dir)
+                cls.backend = cls._load_transformers_backend(
+                    data_dir, device, precision, mmap_weights
+                )
+            else:
+                cls.backend = TorchScriptBackend.load(model_file, device)  # type: ignore
+
+        cls.model = cls.backend.model
+        cls.device = device
+        cls.score_cache.clear()
+        cls.wt_features_cache.clear()
+        cls.is_loaded = True
+
+    @staticmethod
+    def _load_transformers_backend(
+        data_dir: Path, device: torch.device, precision: str, mmap_weights: bool = False
+    ) -> TransformersBackend:
+        from transformers import BertConfig, BertForMaskedLM, logging
 
         @contextmanager
         def hide_warning():
@@ -40,18 +165,47 @@ class ProtBert(SequenceTool, MutationAnalyzer):
             finally:
                 logging.set_verbosity_warning()
 
-        with importlib_resources.path(elaspic2.plugins.protbert.data, "prot_bert_bfd") as data_dir:
-            cls._download_model_data(data_dir)
-            cls.tokenizer = BertTokenizer.from_pretrained(data_dir.as_posix(), do_lower_case=False)
-            cls.model = BertModel.from_pretrained(data_dir.as_posix())
+        def load_pretrained_model():
             with hide_warning():
-                cls.model_lm = BertForMaskedLM.from_pretrained(data_dir.as_posix())
+                return BertForMaskedLM.from_pretrained(data_dir.as_posix())
+
+        if mmap_weights:
+            # Random weights would be replaced by the memory-mapped ones, so skip initializing
+            # them to avoid writing gigabytes of private memory in every worker
+            with skip_init_weights(BertForMaskedLM):
+                model = BertForMaskedLM(BertConfig.from_pretrained(data_dir.as_posix()))
+            state_dict = load_weights_cached(
+                data_dir.joinpath("pytorch_model.bin"),
+                lambda: load_pretrained_model().state_dict(),
+            )
+            assign_weights(model, state_dict)
+        else:
+            model = load_pretrained_model()
 
-        cls.transformers_major_version = int(transformers.__version__.split(".")[0])
-        cls.model = cls.model.eval().to(device)
-        cls.model_lm = cls.model_lm.eval().to(device)
-        cls.device = device
-        cls.is_loaded = True
+        model = model.eval().to(device)
+        if precision == "bf16":
+            model = model.to(torch.bfloat16)
+        elif precision == "int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return TransformersBackend(model)
+
+    @classmethod
+    def export_model(cls, model_file: Union[str, Path], example_length: int = 64) -> None:
+        """Export the loaded model as a static TorchScript graph.
+
+        The exported graph can be loaded using
+        `ProtBert.load_model(backend="torchscript", model_file=model_file)`.
+
+        Args:
+            model_file: File where the graph should be saved.
+            example_length: Length of the sequence used to trace the model.
+        """
+        if not isinstance(cls.backend, TransformersBackend):
+            raise Exception(
+                "Call `ProtBert.load_model(backend='transformers')` before exporting the model."
+            )
+        example_input_ids = cls.tokenizer.encode([["A"] * example_length])  # type: ignore
+        cls.backend.export(model_file, example_input_ids.to(cls.device))
 
     @staticmethod
     def _download_model_data(data_dir: Optional[Path] = None):
@@ -83,95 +237,434 @@ class ProtBert(SequenceTool, MutationAnalyzer):
 
     @classmethod
     def build(  # type: ignore[override]
-        cls, sequence: str, ligand_sequence: Optional[str], remove_hetatms=True
+        cls,
+        sequence: str,
+        ligand_sequence: Optional[str],
+        remove_hetatms=True,
+        window_size: Optional[int] = None,
+        ligand_window_size: Optional[int] = None,
     ) -> ProtBertData:
-        if ligand_sequence is not None:
-            sequence += ligand_sequence
+        """
+        Args:
+            sequence: Sequence of the protein to be mutated.
+            ligand_sequence: Sequence of the interacting protein, if any.
+            remove_hetatms: Whether to remove unknown residues ("X") from the sequences.
+            window_size: If provided, only a window of this many residues of the protein,
+                placed around each mutation, is passed to the model. This bounds the time and
+                memory required for long proteins and large complexes.
+            ligand_window_size: If provided, at most this many residues from the center of the
+                ligand are passed to the model together with each window.
+        """
         if remove_hetatms:
             sequence = sequence.replace("X", "")
-        return ProtBertData(sequence=sequence)
+            if ligand_sequence is not None:
+                ligand_sequence = ligand_sequence.replace("X", "")
+        protein_length = len(sequence)
+        if ligand_sequence is not None:
+            sequence += ligand_sequence
+        # Tokenize the sequence ahead of time, so that it is not tokenized for every mutation
+        cls._get_input_ids(sequence)
+        return ProtBertData(
+            sequence=sequence,
+            protein_length=protein_length,
+            window_size=window_size,
+            ligand_window_size=ligand_window_size,
+        )
 
     @classmethod
-    def analyze_mutation(cls, mutation: str, data: ProtBertData) -> dict:  # type: ignore[override]
+    def _get_tokenizer(cls) -> ProtBertTokenizer:
+        if cls.tokenizer is None:
+            with importlib_resources.path(
+                elaspic2.plugins.protbert.data, "prot_bert_bfd"
+            ) as data_dir:
+                cls.tokenizer = ProtBertTokenizer(data_dir.joinpath("vocab.txt"))
+        return cls.tokenizer
+
+    @classmethod
+    def _get_input_ids(cls, sequence: str) -> torch.Tensor:
+        """Return token ids of `sequence`, including the `[CLS]` and `[SEP]` tokens."""
+        input_ids = cls.input_ids_cache.get(sequence)
+        if input_ids is None:
+            input_ids = cls._get_tokenizer().encode_sequence(sequence)
+            cls.input_ids_cache.put(sequence, input_ids)
+        return input_ids
+
+    @staticmethod
+    def _get_window_slices(data: ProtBertData, mut_idx: int) -> Tuple[slice, slice, int]:
+        """Return the parts of `data.sequence` passed to the model for a mutation at `mut_idx`.
+
+        Windows are placed on a fixed grid with a stride of half the window size, and every
+        mutation uses the window whose central half contains it. All mutations in that central
+        half share the same window, so cached model outputs remain valid between them.
+
+        Returns:
+            Slices of the protein and the ligand in `data.sequence`, and the index of the mutated
+            residue in the window.
+        """
+        protein_length = _get_protein_length(data)
+        ligand_length = len(data.sequence) - protein_length
 
-        mut = Mutation.from_string(mutation)
+        ligand_slice = slice(protein_length, len(data.sequence))
+        if data.ligand_window_size is not None and ligand_length > data.ligand_window_size:
+            ligand_start = protein_length + (ligand_length - data.ligand_window_size) // 2
+            ligand_slice = slice(ligand_start, ligand_start + data.ligand_window_size)
 
-        if data.sequence[int(mut.residue_id) - 1] != mut.residue_wt:
+        if data.window_size is None or protein_length <= data.window_size:
+            return slice(0, protein_length), ligand_slice, mut_idx
+
+        stride = max(data.window_size // 2, 1)
+        start = (mut_idx // stride) * stride - (data.window_size - stride) // 2
+        start = min(max(start, 0), protein_length - data.window_size)
+        return slice(start, start + data.window_size), ligand_slice, mut_idx - start
+
+    @staticmethod
+    def _get_mutation_idx(mut: Mutation, data: ProtBertData) -> int:
+        """Return the index of the residue affected by `mut` in `data.sequence`.
+
+        Raises:
+            ProtBertAnalyzeError: If `mut` is not in the mutated protein (e.g. it affects the
+                ligand), or if it does not match the protein sequence.
+        """
+        mut_idx = int(mut.residue_id) - 1
+        if not 0 <= mut_idx < _get_protein_length(data):
+            raise ProtBertAnalyzeError(f"Mutation is outside of protein ({mut}, {data.sequence}).")
+        if data.sequence[mut_idx] != mut.residue_wt:
             raise ProtBertAnalyzeError(
                 f"Mutation does not match sequence ({mut}, {data.sequence})."
             )
+        return mut_idx
+
+    @staticmethod
+    def _get_score_cache_key(window: Tuple[str, int]) -> Tuple[bytes, int]:
+        """Return the key of `window` in `score_cache`.
+
+        Sequences are replaced by their digest, so that cache entries do not hold on to
+        a copy of the full window sequence.
+        """
+        sequence, mut_idx = window
+        return hashlib.blake2b(sequence.encode(), digest_size=16).digest(), mut_idx
 
-        scores_dict = cls._get_scores(data, mut)
-        features_dict = cls._get_features(data, mut)
+    @classmethod
+    def _get_window_input_ids(
+        cls, data: ProtBertData, protein_slice: slice, ligand_slice: slice
+    ) -> torch.Tensor:
+        """Return token ids of the window, sliced from the token ids of the full sequence."""
+        input_ids = cls._get_input_ids(data.sequence)
+        window_length = (protein_slice.stop - protein_slice.start) + (
+            ligand_slice.stop - ligand_slice.start
+        )
+        if window_length == len(data.sequence):
+            return input_ids
+        residue_ids = input_ids[1:-1]
+        return torch.cat(
+            [input_ids[:1], residue_ids[protein_slice], residue_ids[ligand_slice], input_ids[-1:]]
+        )
 
-        return {**scores_dict, **features_dict}
+    @classmethod
+    def analyze_mutation(cls, mutation: str, data: ProtBertData) -> dict:  # type: ignore[override]
+        return cls.analyze_mutations([mutation], data)[0]
 
     @classmethod
-    def _get_scores(cls, data: ProtBertData, mut: Mutation) -> dict:
+    def analyze_mutations(  # type: ignore[override]
+        cls, mutations: List[str], data: ProtBertData, batch_size: int = 16
+    ) -> List[dict]:
+        """Analyze multiple mutations in the same protein.
+
+        Args:
+            mutations: Mutations to analyze.
+            data: Output of `ProtBert.build`.
+            batch_size: Maximum number of sequences to pass through the model at once.
+
+        Returns:
+            One dictionary of scores and features for every mutation in `mutations`.
+            Features are returned as 1-D float32 arrays.
+        """
         if cls.tokenizer is None or cls.model is None:
             raise Exception("Call `ProtBert.load_model()` before using this class.")
 
-        from transformers import pipeline
+        mut_list = []
+        for mutation in mutations:
+            mut = Mutation.from_string(mutation)
+            cls._get_mutation_idx(mut, data)
+            mut_list.append(mut)
+
+        windows = []
+        # Every window sequence is created once and shared by all mutations that use it
+        window_sequences: Dict[Tuple[int, int, int, int], str] = {}
+        input_ids_by_sequence = {}
+        for mut in mut_list:
+            protein_slice, ligand_slice, window_idx = cls._get_window_slices(
+                data, int(mut.residue_id) - 1
+            )
+            slice_bounds = (
+                protein_slice.start,
+                protein_slice.stop,
+                ligand_slice.start,
+                ligand_slice.stop,
+            )
+            if slice_bounds not in window_sequences:
+                window_sequence = data.sequence[protein_slice] + data.sequence[ligand_slice]
+                window_sequences[slice_bounds] = window_sequence
+                input_ids_by_sequence[window_sequence] = cls._get_window_input_ids(
+                    data, protein_slice, ligand_slice
+                )
+            windows.append((window_sequences[slice_bounds], window_idx))
+
+        return cls._analyze_windows(
+            windows,
+            mut_list,
+            input_ids_by_sequence,
+            functools.partial(cls._run_batches, batch_size=batch_size),
+        )
+
+    @classmethod
+    def _analyze_windows(
+        cls,
+        windows: List[Tuple[str, int]],
+        mut_list: List[Mutation],
+        input_ids_by_sequence: Dict[str, torch.Tensor],
+        run_batches: BatchRunner,
+    ) -> List[dict]:
+        """Return scores and features for mutations in the sequences passed to the model.
+
+        Every masked sequence, wild-type sequence and mutant sequence is evaluated once,
+        and its outputs are shared by all mutations that require them.
+
+        Args:
+            windows: Sequence passed to the model for every mutation in `mut_list`, and
+                the index of the mutated residue in that sequence.
+            mut_list: Mutations to analyze.
+            input_ids_by_sequence: Token ids of every sequence in `windows`.
+            run_batches: Function used to evaluate the model on lists of token ids.
+        """
+        assert cls.tokenizer is not None
+        assert all(
+            sequence[mut_idx] == mut.residue_wt
+            for (sequence, mut_idx), mut in zip(windows, mut_list)
+        )
+        mut_keys = [(window, mut.residue_mut) for window, mut in zip(windows, mut_list)]
 
-        def guess_transformer_device(device: torch.device) -> int:
-            if device.type == "cpu":
-                return -1
-            elif ":" in device.type:
-                return int(cls.device.type.split(":")[-1])
-            else:
-                assert device.type == "cuda"
-                return 0
-
-        pipeline_kwargs = {"top_k": 30} if cls.transformers_major_version >= 4 else {"topk": 30}
-        unmasker = pipeline(
-            "fill-mask",
-            model=cls.model_lm,
-            tokenizer=cls.tokenizer,
-            device=guess_transformer_device(cls.device),
-            **pipeline_kwargs,
+        probas_by_window = cls._get_masked_probas(windows, input_ids_by_sequence, run_batches)
+        wt_features_by_sequence = cls._get_wt_features(
+            [sequence for sequence, _ in windows], input_ids_by_sequence, run_batches
         )
+        mut_features_by_key = cls._get_mut_features(mut_keys, input_ids_by_sequence, run_batches)
+
+        results = []
+        for (sequence, mut_idx), mut, mut_key in zip(windows, mut_list, mut_keys):
+            probas = probas_by_window[(sequence, mut_idx)]
+            output_wt, output_mean_wt = wt_features_by_sequence[sequence]
+            output_residue_mut, output_mean_mut = mut_features_by_key[mut_key]
+            results.append(
+                {
+                    "score_wt": probas[cls.tokenizer.convert_tokens_to_ids(mut.residue_wt)].item(),
+                    "score_mut": probas[
+                        cls.tokenizer.convert_tokens_to_ids(mut.residue_mut)
+                    ].item(),
+                    # Residue features are taken at `mut_idx`, without skipping the `[CLS]` token,
+                    # as was done when training the ELASPIC2 models
+                    "features_residue_wt": output_wt[mut_idx].numpy().copy(),
+                    "features_protein_wt": output_mean_wt.numpy().copy(),
+                    "features_residue_mut": output_residue_mut.numpy().copy(),
+                    "features_protein_mut": output_mean_mut.numpy().copy(),
+                }
+            )
+        return results
 
-        aa_list = list(data.sequence)
-        assert aa_list[int(mut.residue_id) - 1] == mut.residue_wt
-        aa_list[int(mut.residue_id) - 1] = "[MASK]"
-        scores = unmasker(" ".join(aa_list))
-        score_wt = next((s["score"] for s in scores if s["token_str"] == mut.residue_wt))
-        score_mut = next((s["score"] for s in scores if s["token_str"] == mut.residue_mut))
-        return {"score_wt": score_wt, "score_mut": score_mut}
+    @classmethod
+    def _get_masked_probas(
+        cls,
+        windows: List[Tuple[str, int]],
+        input_ids_by_sequence: Dict[str, torch.Tensor],
+        run_batches: BatchRunner,
+    ) -> Dict[Tuple[str, int], np.ndarray]:
+        """Return the probability of every token in the vocabulary at each masked position.
+
+        Probabilities are cached, so all mutations at the same position require a single forward
+        pass. Positions that are not in the cache are masked and evaluated in batches.
+
+        Args:
+            windows: Sequences and the indices of the residues that should be masked.
+            input_ids_by_sequence: Token ids of every sequence in `windows`.
+            run_batches: Function used to evaluate the model on lists of token ids.
+        """
+        assert cls.tokenizer is not None
+        probas_by_window: Dict[Tuple[str, int], np.ndarray] = {}
+        missing_windows = []
+        for window in dict.fromkeys(windows):
+            probas = cls.score_cache.get(cls._get_score_cache_key(window))
+            if probas is None:
+                missing_windows.append(window)
+            else:
+                probas_by_window[window] = probas
+
+        masked_input_ids = []
+        # Offset by one to account for the `[CLS]` token
+        mask_positions = [mut_idx + 1 for _, mut_idx in missing_windows]
+        for (sequence, _), mask_position in zip(missing_windows, mask_positions):
+            input_ids = input_ids_by_sequence[sequence].clone()
+            input_ids[mask_position] = cls.tokenizer.mask_token_id
+            masked_input_ids.append(input_ids)
+
+        for batch_idxs, _, logits in run_batches(masked_input_ids, mask_positions):
+            assert logits is not None
+            batch_probas = torch.softmax(logits, dim=-1).cpu()
+            for idx, probas in zip(batch_idxs, batch_probas.numpy()):
+                probas = probas.copy()
+                cls.score_cache.put(cls._get_score_cache_key(missing_windows[idx]), probas)
+                probas_by_window[missing_windows[idx]] = probas
+        return probas_by_window
 
     @classmethod
-    def _get_features(cls, data: ProtBertData, mut: Mutation) -> dict:
-        if cls.tokenizer is None or cls.model is None:
-            raise Exception("Call `ProtBert.load_model()` before using this class.")
+    def _get_wt_features(
+        cls,
+        sequences: List[str],
+        input_ids_by_sequence: Dict[str, torch.Tensor],
+        run_batches: BatchRunner,
+    ) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+        """Return hidden states and their mean for every wild-type sequence in `sequences`.
+
+        Results are cached, so every wild-type sequence goes through the model only once.
+        """
+        wt_features_by_sequence: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        missing_sequences = []
+        for sequence in dict.fromkeys(sequences):
+            wt_features = cls.wt_features_cache.get(sequence)
+            if wt_features is None:
+                missing_sequences.append(sequence)
+            else:
+                wt_features_by_sequence[sequence] = wt_features
+
+        wt_input_ids = [input_ids_by_sequence[sequence] for sequence in missing_sequences]
+        for batch_idxs, hidden_states, _ in run_batches(wt_input_ids, None):
+            for row, idx in enumerate(batch_idxs):
+                # Copy, so that cached hidden states do not keep the whole batch in memory
+                output_wt = hidden_states[row, : len(wt_input_ids[idx])].to("cpu", copy=True)
+                wt_features = (output_wt, output_wt.mean(dim=0))
+                cls.wt_features_cache.put(missing_sequences[idx], wt_features)
+                wt_features_by_sequence[missing_sequences[idx]] = wt_features
+        return wt_features_by_sequence
 
-        mut_idx = int(mut.residue_id) - 1
+    @classmethod
+    def _get_mut_features(
+        cls,
+        mut_keys: List[Tuple[Tuple[str, int], str]],
+        input_ids_by_sequence: Dict[str, torch.Tensor],
+        run_batches: BatchRunner,
+    ) -> Dict[Tuple[Tuple[str, int], str], Tuple[torch.Tensor, torch.Tensor]]:
+        """Return hidden states of the mutated residue and their mean for mutant sequences.
+
+        Args:
+            mut_keys: Window sequences, indices of the mutated residues and mutant residues.
+            input_ids_by_sequence: Token ids of every window sequence in `mut_keys`.
+            run_batches: Function used to evaluate the model on lists of token ids.
+        """
+        assert cls.tokenizer is not None
+        mut_keys = list(dict.fromkeys(mut_keys))
+        mut_input_ids = []
+        for (sequence, mut_idx), residue_mut in mut_keys:
+            input_ids = input_ids_by_sequence[sequence].clone()
+            input_ids[mut_idx + 1] = cls.tokenizer.convert_tokens_to_ids(residue_mut)
+            mut_input_ids.append(input_ids)
+
+        mut_features_by_key = {}
+        for batch_idxs, hidden_states, _ in run_batches(mut_input_ids, None):
+            for row, idx in enumerate(batch_idxs):
+                (_, mut_idx), _ = mut_keys[idx]
+                output_mut = hidden_states[row, : len(mut_input_ids[idx])]
+                mut_features_by_key[mut_keys[idx]] = (
+                    output_mut[mut_idx].cpu(),
+                    output_mut.mean(dim=0).cpu(),
+                )
+        return mut_features_by_key
 
-        aa_wt_list = list(data.sequence)
-        aa_mut_list = aa_wt_list[:]
-        aa_mut_list[mut_idx] = mut.residue_mut
-        assert aa_wt_list[mut_idx] == mut.residue_wt
-        assert aa_mut_list[mut_idx] == mut.residue_mut
+    @classmethod
+    def _run_batches(
+        cls,
+        input_ids_list: List[torch.Tensor],
+        logits_positions: Optional[List[int]] = None,
+        batch_size: int = 16,
+    ) -> Iterator[Tuple[List[int], torch.Tensor, Optional[torch.Tensor]]]:
+        """Run the model on consecutive batches of up to `batch_size` sequences.
+
+        See `BatchRunner` for a description of the arguments and outputs.
+        """
+        for start in range(0, len(input_ids_list), batch_size):
+            batch_idxs = list(range(start, min(start + batch_size, len(input_ids_list))))
+            yield (batch_idxs, *cls._run_batch(input_ids_list, logits_positions, batch_idxs))
 
-        encoded_input_wt = cls.tokenizer(" ".join(list(aa_wt_list)), return_tensors="pt").to(
-            cls.device
+    @classmethod
+    def _run_batch(
+        cls,
+        input_ids_list: List[torch.Tensor],
+        logits_positions: Optional[List[int]],
+        batch_idxs: List[int],
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Pad the sequences at `batch_idxs` into a single batch and run the model on it.
+
+        Returns:
+            Hidden states of the sequences and, if `logits_positions` is provided,
+            token logits at the positions of these sequences.
+        """
+        assert cls.tokenizer is not None
+        input_ids, attention_mask = cls.tokenizer.pad([input_ids_list[idx] for idx in batch_idxs])
+        return cls._run_model(
+            input_ids.to(cls.device),
+            logits_positions=(
+                None
+                if logits_positions is None
+                else torch.tensor([logits_positions[idx] for idx in batch_idxs], device=cls.device)
+            ),
+            # Batches without padding do not need an attention mask
+            attention_mask=None if attention_mask.all() else attention_mask.to(cls.device),
         )
-        if cls.transformers_major_version >= 4:
-            encoded_input_wt["return_dict"] = False
-        output_wt, output_cls_wt = cls.model(**encoded_input_wt)
 
-        encoded_input_mut = cls.tokenizer(" ".join(list(aa_mut_list)), return_tensors="pt").to(
-            cls.device
-        )
-        if cls.transformers_major_version >= 4:
-            encoded_input_mut["return_dict"] = False
-        output_mut, output_cls_mut = cls.model(**encoded_input_mut)
-
-        return {
-            "features_residue_wt": output_wt[:, mut_idx].squeeze().data.cpu().numpy().tolist(),
-            "features_protein_wt": output_wt.mean(dim=1).squeeze().data.cpu().numpy().tolist(),
-            "features_residue_mut": output_mut[:, mut_idx].squeeze().data.cpu().numpy().tolist(),
-            "features_protein_mut": output_mut.mean(dim=1).squeeze().data.cpu().numpy().tolist(),
-        }
+    @classmethod
+    def _run_model(
+        cls,
+        input_ids: torch.Tensor,
+        logits_positions: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Run the shared encoder and, if requested, the language model head on its output.
+
+        Args:
+            input_ids: Token ids of shape `[batch_size, num_tokens]`.
+            logits_positions: Position in every row of `input_ids` at which token logits are
+                required. The language model head is applied to those positions only.
+            attention_mask: Mask of the tokens that are not padding, required if
+                `input_ids` contains padded sequences.
+
+        Returns:
+            Hidden states of the last encoder layer and, if `logits_positions` is provided,
+            token logits of shape `[batch_size, vocab_size]`, both in full precision.
+        """
+        assert cls.backend is not None
+        with InferenceRuntime.inference():
+            hidden_states = cls.backend.encode(input_ids, attention_mask)
+            logits = None
+            if logits_positions is not None:
+                rows = torch.arange(len(logits_positions), device=hidden_states.device)
+                logits = cls.backend.lm_head(hidden_states[rows, logits_positions]).float()
+            hidden_states = hidden_states.float()
+        return hidden_states, logits
+
+
+def _is_bf16_matmul_supported(device: torch.device) -> bool:
+    x = torch.ones(2, 2, dtype=torch.bfloat16, device=device)
+    try:
+        torch.addmm(x, x, x)
+    except RuntimeError:
+        return False
+    return True
+
+
+def _get_protein_length(data: ProtBertData) -> int:
+    return data.protein_length if data.protein_length is not None else len(data.sequence)
+
+
+def _get_nbytes(tensor: torch.Tensor) -> int:
+    return tensor.element_size() * tensor.nelement()
 
 
 class ProtBertBuildError(Exception):
@@ -0,0 +1,142 @@
+import itertools
+from concurrent.futures import Future
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import torch
+from kmtools.structure_tools.types import DomainMutation as Mutation
+
+from elaspic2.plugins.protbert.protbert import ProtBert, ProtBertAnalyzeError
+from elaspic2.plugins.protbert.types import ProtBertData
+
+
+class _Request(NamedTuple):
+    mut: Mutation
+    # Sequence passed to the model and the index of the mutated residue in that sequence
+    window: Tuple[str, int]
+    future: Future
+
+
+class ProtBertBatchScheduler:
+    """Batch ProtBert forward passes required by mutations in many different proteins.
+
+    Mutations are queued using `submit` and are evaluated when `flush` is called, or once
+    `max_pending` mutations have been queued. Forward passes required by all queued mutations
+    are grouped into buckets of sequences with similar lengths, and every bucket is evaluated
+    in padded batches of up to `batch_size` sequences.
+
+    Example:
+        with ProtBertBatchScheduler() as scheduler:
+            futures = [scheduler.submit(mutation, data) for mutation, data in mutations]
+        results = [future.result() for future in futures]
+    """
+
+    def __init__(self, batch_size: int = 32, bucket_width: int = 32, max_pending: int = 4096):
+        """
+        Args:
+            batch_size: Maximum number of sequences to pass through the model at once.
+            bucket_width: Maximum difference in the number of tokens between sequences that
+                are padded to the same length.
+            max_pending: Number of queued mutations after which they are evaluated.
+        """
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.max_pending = max_pending
+        self._pending: List[_Request] = []
+        # Window sequences keyed by protein sequence and slice bounds, so that every window
+        # sequence is created once and shared by all queued mutations that use it
+        self._window_sequences: Dict[Tuple[str, int, int, int, int], str] = {}
+        self._input_ids_by_sequence: Dict[str, torch.Tensor] = {}
+
+    def __enter__(self) -> "ProtBertBatchScheduler":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.flush()
+
+    def submit(self, mutation: str, data: ProtBertData) -> Future:
+        """Queue `mutation` in the protein described by `data` for evaluation.
+
+        Returns:
+            Future that resolves to the same dictionary as `ProtBert.analyze_mutation`.
+        """
+        future: Future = Future()
+        mut = Mutation.from_string(mutation)
+        try:
+            mut_idx = ProtBert._get_mutation_idx(mut, data)
+        except ProtBertAnalyzeError as error:
+            future.set_exception(error)
+            return future
+
+        protein_slice, ligand_slice, window_idx = ProtBert._get_window_slices(data, mut_idx)
+        window_key = (
+            data.sequence,
+            protein_slice.start,
+            protein_slice.stop,
+            ligand_slice.start,
+            ligand_slice.stop,
+        )
+        window_sequence = self._window_sequences.get(window_key)
+        if window_sequence is None:
+            window_sequence = data.sequence[protein_slice] + data.sequence[ligand_slice]
+            self._window_sequences[window_key] = window_sequence
+            if window_sequence not in self._input_ids_by_sequence:
+                self._input_ids_by_sequence[window_sequence] = ProtBert._get_window_input_ids(
+                    data, protein_slice, ligand_slice
+                )
+        self._pending.append(_Request(mut, (window_sequence, window_idx), future))
+
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+        return future
+
+    def flush(self) -> None:
+        """Evaluate all queued mutations and resolve their futures."""
+        requests, self._pending = self._pending, []
+        input_ids_by_sequence, self._input_ids_by_sequence = self._input_ids_by_sequence, {}
+        self._window_sequences = {}
+        if not requests:
+            return
+
+        try:
+            results = self._analyze(requests, input_ids_by_sequence)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def _analyze(
+        self, requests: List[_Request], input_ids_by_sequence: Dict[str, torch.Tensor]
+    ) -> List[dict]:
+        if ProtBert.tokenizer is None or ProtBert.model is None:
+            raise Exception("Call `ProtBert.load_model()` before using this class.")
+
+        return ProtBert._analyze_windows(
+            [request.window for request in requests],
+            [request.mut for request in requests],
+            input_ids_by_sequence,
+            self._run_batches,
+        )
+
+    def _run_batches(
+        self, input_ids_list: List[torch.Tensor], logits_positions: Optional[List[int]] = None
+    ) -> Iterator[Tuple[List[int], torch.Tensor, Optional[torch.Tensor]]]:
+        """Run the model on sequences of different lengths, grouped into length buckets.
+
+        See `elaspic2.plugins.protbert.protbert.BatchRunner` for a description of the arguments
+        and outputs.
+        """
+        order = sorted(range(len(input_ids_list)), key=lambda idx: len(input_ids_list[idx]))
+        buckets = itertools.groupby(
+            order, key=lambda idx: (len(input_ids_list[idx]) - 1) // self.bucket_width
+        )
+        for _, bucket in buckets:
+            bucket_idxs = list(bucket)
+            for start in range(0, len(bucket_idxs), self.batch_size):
+                batch_idxs = bucket_idxs[start : start + self.batch_size]
+                yield (
+                    batch_idxs,
+                    *ProtBert._run_batch(input_ids_list, logits_positions, batch_idxs),
+                )
@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class ProtBertTokenizer:
+    """Tokenizer for sequences of amino acids, using the ProtBert vocabulary.
+
+    Every residue maps to a single token, so this produces the same token ids as
+    `transformers.BertTokenizer` without having to import `transformers`.
+    """
+
+    cls_token = "[CLS]"
+    sep_token = "[SEP]"
+    mask_token = "[MASK]"
+    unk_token = "[UNK]"
+    pad_token = "[PAD]"
+
+    def __init__(self, vocab_file: Union[str, Path]):
+        with Path(vocab_file).open("rt") as fin:
+            tokens = [line.rstrip("\n") for line in fin]
+        self.vocab = {token: idx for idx, token in enumerate(tokens) if token}
+        # Maps the ASCII code of every single-character token (i.e. residue) to its id
+        self._residue_id_table = np.full(256, self.vocab[self.unk_token], dtype=np.int64)
+        for token, idx in self.vocab.items():
+            if len(token) == 1 and ord(token) < 256:
+                self._residue_id_table[ord(token)] = idx
+
+    @property
+    def cls_token_id(self) -> int:
+        return self.vocab[self.cls_token]
+
+    @property
+    def sep_token_id(self) -> int:
+        return self.vocab[self.sep_token]
+
+    @property
+    def mask_token_id(self) -> int:
+        return self.vocab[self.mask_token]
+
+    @property
+    def pad_token_id(self) -> int:
+        return self.vocab[self.pad_token]
+
+    def convert_tokens_to_ids(self, tokens: Union[str, Sequence[str]]) -> Union[int, List[int]]:
+        unk_token_id = self.vocab[self.unk_token]
+        if isinstance(tokens, str):
+            return self.vocab.get(tokens, unk_token_id)
+        return [self.vocab.get(token, unk_token_id) for token in tokens]
+
+    def encode(self, tokens_list: Sequence[Sequence[str]]) -> torch.Tensor:
+        """Convert lists of tokens of the same length into a tensor of input ids.
+
+        Args:
+            tokens_list: Lists of tokens (residues or special tokens) to encode.
+
+        Returns:
+            Tensor of shape `[len(tokens_list), num_tokens + 2]`, where every row starts with
+            the `[CLS]` token and ends with the `[SEP]` token.
+        """
+        input_ids = [
+            self.convert_tokens_to_ids([self.cls_token, *tokens, self.sep_token])
+            for tokens in tokens_list
+        ]
+        return torch.tensor(input_ids, dtype=torch.long)
+
+    def encode_sequence(self, sequence: str) -> torch.Tensor:
+        """Convert a sequence of residues into a tensor of input ids.
+
+        Residues are mapped to token ids using a lookup table, without creating a token for
+        every residue.
+
+        Returns:
+            Tensor of shape `[len(sequence) + 2]`, starting with the `[CLS]` token and ending with
+            the `[SEP]` token.
+        """
+        residue_codes = np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)
+        input_ids = np.empty(len(residue_codes) + 2, dtype=np.int64)
+        input_ids[0] = self.cls_token_id
+        input_ids[1:-1] = self._residue_id_table[residue_codes]
+        input_ids[-1] = self.sep_token_id
+        return torch.from_numpy(input_ids)
+
+    def pad(self, input_ids_list: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Stack token ids of different lengths into a padded batch.
+
+        Returns:
+            Tensor of input ids of shape `[len(input_ids_list), max_num_tokens]` and the
+            corresponding attention mask, which is zero at padding positions.
+        """
+        max_length = max(len(input_ids) for input_ids in input_ids_list)
+        input_ids = torch.full((len(input_ids_list), max_length), self.pad_token_id)
+        attention_mask = torch.zeros((len(input_ids_list), max_length), dtype=torch.long)
+        for i, row_input_ids in enumerate(input_ids_list):
+            input_ids[i, : len(row_input_ids)] = row_input_ids
+            attention_mask[i, : len(row_input_ids)] = 1
+        return input_ids, attention_mask
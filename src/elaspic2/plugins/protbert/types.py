@@ -1,5 +1,9 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
 
 class ProtBertData(NamedTuple):
     sequence: str
+    # Number of residues in `sequence` that belong to the protein; the rest belong to the ligand
+    protein_length: Optional[int] = None
+    window_size: Optional[int] = None
+    ligand_window_size: Optional[int] = None
@@ -0,0 +1,114 @@
+"""Inference-only implementation of `model.Net`.
+
+Modules are laid out so that the state dict of `model.Net` can be loaded as is. Dropout layers,
+which do nothing during inference, are left out, and messages are aggregated using
+`torch.Tensor.index_add_`, so neither `torch_geometric` nor `proteinsolver` are required.
+The model can be compiled using `torch.jit.script`.
+
+Edge indices may be stored as int32 and edge attributes in half precision. Edge indices are
+converted to int64 once per forward pass, and edge attributes are converted to the type of
+the model one chunk of edges at a time.
+"""
+
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class EdgeConvMod(nn.Module):
+    def __init__(self, input_size: int, hidden_size: int, output_size: int):
+        super().__init__()
+        self.nn = nn.Sequential(
+            nn.Linear(input_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, output_size),
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.nn(x)
+
+
+class EdgeConvBatch(nn.Module):
+    def __init__(self, input_size: int, hidden_size: int, output_size: int):
+        super().__init__()
+        self.gnn = EdgeConvMod(input_size, hidden_size, output_size)
+        self.x_postprocess = nn.Sequential(nn.LayerNorm(output_size))
+        self.edge_attr_postprocess = nn.Sequential(nn.LayerNorm(output_size))
+
+    def forward(
+        self, x: torch.Tensor, edge_index: torch.Tensor, edge_attr: torch.Tensor, chunk_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return node and edge features with the output of this layer added to them.
+
+        Edges are processed in chunks of `chunk_size`, and `edge_attr` is updated in place.
+        `edge_index` must be int64, so that chunks can be used to index `x` without a copy.
+        """
+        x_out = torch.zeros_like(x)
+        for start in range(0, edge_index.size(1), chunk_size):
+            end = start + chunk_size
+            row, col = edge_index[0, start:end], edge_index[1, start:end]
+            edge_out = self.gnn(torch.cat([x[row], x[col], edge_attr[start:end]], dim=-1))
+            x_out.index_add_(0, row, edge_out)
+            edge_attr[start:end] += self.edge_attr_postprocess(edge_out)
+        return x + self.x_postprocess(x_out), edge_attr
+
+
+class Net(nn.Module):
+    # If set, edges are processed in chunks of this size, which bounds peak memory
+    edge_chunk_size: Optional[int]
+
+    def __init__(self, x_input_size: int, adj_input_size: int, hidden_size: int, output_size: int):
+        super().__init__()
+
+        self.embed_x = nn.Sequential(
+            nn.Embedding(x_input_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.LayerNorm(hidden_size),
+        )
+        self.embed_adj = nn.Sequential(
+            nn.Linear(adj_input_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.LayerNorm(hidden_size),
+        )
+        self.graph_conv_0 = EdgeConvBatch(3 * hidden_size, 2 * hidden_size, hidden_size)
+        self.graph_conv = nn.ModuleList(
+            [EdgeConvBatch(3 * hidden_size, 2 * hidden_size, hidden_size) for _ in range(3)]
+        )
+        self.linear_out = nn.Linear(hidden_size, output_size)
+        self.edge_chunk_size = None
+
+    def forward(
+        self, x: torch.Tensor, edge_index: torch.Tensor, edge_attr: torch.Tensor
+    ) -> torch.Tensor:
+        edge_chunk_size = self.edge_chunk_size
+        if edge_chunk_size is None:
+            edge_chunk_size = max(edge_index.size(1), 1)
+
+        # Cast once here, rather than for every chunk of every layer
+        edge_index = edge_index.long()
+
+        x = self.embed_x(x)
+        dtype = x.dtype
+        if edge_chunk_size >= edge_attr.size(0):
+            edge_attr = self.embed_adj(edge_attr.to(dtype))
+        else:
+            edge_attr = torch.cat(
+                [
+                    self.embed_adj(edge_attr[start : start + edge_chunk_size].to(dtype))
+                    for start in range(0, edge_attr.size(0), edge_chunk_size)
+                ]
+            )
+
+        x, edge_attr = self.graph_conv_0(x, edge_index, edge_attr, edge_chunk_size)
+        for graph_conv in self.graph_conv:
+            x = F.relu(x)
+            edge_attr = F.relu_(edge_attr)
+            x, edge_attr = graph_conv(x, edge_index, edge_attr, edge_chunk_size)
+
+        x = self.linear_out(x)
+
+        return x
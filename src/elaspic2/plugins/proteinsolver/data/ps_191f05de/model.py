@@ -145,6 +145,9 @@ class MyAttn(torch.nn.Module):
 
 
 class Net(nn.Module):
+    # If set, edges are processed in chunks of this size during inference (see `forward_chunked`)
+    edge_chunk_size = None
+
     def __init__(self, x_input_size, adj_input_size, hidden_size, output_size):
         super().__init__()
 
@@ -177,6 +180,8 @@ class Net(nn.Module):
         self.linear_out = nn.Linear(hidden_size, output_size)
 
     def forward(self, x, edge_index, edge_attr):
+        if self.edge_chunk_size is not None and not self.training and edge_attr is not None:
+            return self.forward_chunked(x, edge_index, edge_attr, self.edge_chunk_size)
 
         x = self.embed_x(x)
         # edge_index, _ = add_self_loops(edge_index)  # We should remove self loops in this case!
@@ -197,6 +202,41 @@ class Net(nn.Module):
 
         return x
 
+    def forward_chunked(self, x, edge_index, edge_attr, edge_chunk_size):
+        """Evaluate the network, processing at most `edge_chunk_size` edges at a time.
+
+        Gives the same result as `forward` in evaluation mode, but the concatenated inputs and
+        hidden activations of the edge networks exist for only one chunk of edges at a time.
+        Node features are accumulated with a streaming scatter-add, and edge features are
+        updated in place, so peak memory grows with the number of edges by only
+        `hidden_size` values per edge.
+        """
+        row, col = edge_index
+        chunks = [
+            slice(start, start + edge_chunk_size)
+            for start in range(0, edge_index.size(1), edge_chunk_size)
+        ]
+
+        x = self.embed_x(x)
+        edge_attr = torch.cat([self.embed_adj(edge_attr[chunk]) for chunk in chunks])
+
+        for i, graph_conv in enumerate([self.graph_conv_0, *self.graph_conv]):
+            if i > 0:
+                x = F.relu(x)
+            x_out = x.new_zeros(x.size())
+            for chunk in chunks:
+                edge_attr_chunk = edge_attr[chunk] if i == 0 else F.relu(edge_attr[chunk])
+                edge_out = graph_conv.gnn.nn(
+                    torch.cat([x[row[chunk]], x[col[chunk]], edge_attr_chunk], dim=-1)
+                )
+                x_out.index_add_(0, row[chunk], edge_out)
+                edge_attr[chunk] = edge_attr_chunk + graph_conv.edge_attr_postprocess(edge_out)
+            x = x + graph_conv.x_postprocess(x_out)
+
+        x = self.linear_out(x)
+
+        return x
+
 
 def _get_clones(module, N):
     return ModuleList([copy.deepcopy(module) for i in range(N)])
@@ -1,10 +1,15 @@
-from typing import Tuple
+import functools
+from typing import List, Optional, Sequence, Tuple, Union
 
+import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
 from kmtools import structure_tools
 from kmtools.structure_tools.types import DomainMutation as Mutation
 
+from elaspic2.core import InferenceRuntime
+
 
 def extract_seq_and_adj(structure, chain_idxs, remove_hetatms=False):
     from proteinsolver.utils import ProteinData
@@ -39,41 +44,311 @@ def get_interaction_dataset_wdistances(
     domain_structure = structure_tools.extract_domain(
         structure, domain_defs, remove_hetatms=remove_hetatms
     )
-    distances_core = structure_tools.get_distances(
-        domain_structure.to_dataframe(), r_cutoff, groupby="residue"
-    )
+    atom_coords, atom_residue_idxs = get_atom_coords(domain_structure)
+    distances_core = get_residue_distances(atom_coords, atom_residue_idxs, r_cutoff)
     assert (distances_core["residue_idx_1"] <= distances_core["residue_idx_2"]).all()
     return domain_structure, distances_core
 
 
-def get_mutation_score(
+def get_atom_coords(structure) -> Tuple[np.ndarray, np.ndarray]:
+    """Return coordinates of all atoms in the first model of `structure`.
+
+    Returns:
+        Array of atom coordinates and an array with the index of the residue of every atom,
+        with residues numbered consecutively across all chains.
+    """
+    atom_coords = []
+    atom_residue_idxs = []
+    residue_idx = 0
+    for chain in structure[0]:
+        for residue in chain:
+            for atom in residue:
+                atom_coords.append(atom.coord)
+                atom_residue_idxs.append(residue_idx)
+            residue_idx += 1
+    return (
+        np.array(atom_coords, dtype=np.float64).reshape(-1, 3),
+        np.array(atom_residue_idxs, dtype=np.int64),
+    )
+
+
+def get_residue_distances(
+    atom_coords: np.ndarray,
+    atom_residue_idxs: np.ndarray,
+    r_cutoff: float = 12,
+    chunk_size: int = 16384,
+) -> pd.DataFrame:
+    """Find all pairs of residues with at least one pair of atoms within `r_cutoff` Å.
+
+    Close atoms are found using a KD-tree, so the running time grows close to linearly with
+    the number of atoms. Atoms are processed in chunks of `chunk_size` in order to bound
+    the number of atom pairs held in memory at once.
+
+    Returns:
+        Dataframe with columns `residue_idx_1`, `residue_idx_2` and `distance`, where
+        `residue_idx_1 < residue_idx_2` and `distance` is the minimum distance between
+        the atoms of the two residues.
+    """
+    from scipy.spatial import cKDTree
+
+    num_residues = int(atom_residue_idxs.max()) + 1 if len(atom_residue_idxs) else 0
+    tree = cKDTree(atom_coords)
+
+    pair_keys_list, distances_list = [], []
+    for start in range(0, len(atom_coords), chunk_size):
+        chunk_tree = cKDTree(atom_coords[start : start + chunk_size])
+        atom_pairs = chunk_tree.sparse_distance_matrix(tree, r_cutoff, output_type="ndarray")
+        residue_idxs_1 = atom_residue_idxs[atom_pairs["i"] + start]
+        residue_idxs_2 = atom_residue_idxs[atom_pairs["j"]]
+        # Every pair of residues is seen in both orders, so keep only one of them
+        mask = residue_idxs_1 < residue_idxs_2
+        pair_keys, distances = _get_min_distances(
+            residue_idxs_1[mask] * num_residues + residue_idxs_2[mask], atom_pairs["v"][mask]
+        )
+        pair_keys_list.append(pair_keys)
+        distances_list.append(distances)
+
+    if pair_keys_list:
+        pair_keys, distances = _get_min_distances(
+            np.concatenate(pair_keys_list), np.concatenate(distances_list)
+        )
+    else:
+        pair_keys, distances = np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    return pd.DataFrame(
+        {
+            "residue_idx_1": pair_keys // max(num_residues, 1),
+            "residue_idx_2": pair_keys % max(num_residues, 1),
+            "distance": distances,
+        }
+    )
+
+
+def _get_min_distances(
+    pair_keys: np.ndarray, distances: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return unique `pair_keys`, in sorted order, and the minimum distance for each."""
+    order = np.lexsort((distances, pair_keys))
+    pair_keys, distances = pair_keys[order], distances[order]
+    is_first = np.ones(len(pair_keys), dtype=bool)
+    is_first[1:] = pair_keys[1:] != pair_keys[:-1]
+    return pair_keys[is_first], distances[is_first]
+
+
+def get_mutation_scores(
     net: nn.Module,
     x: torch.Tensor,
     edge_index: torch.Tensor,
     edge_attr: torch.Tensor,
-    mutation: Mutation,
+    mutations: List[Mutation],
     num_categories: int = 20,
-) -> Tuple[float, float]:
-    import proteinsolver
+    batch_size: int = 1,
+    num_hops: Optional[int] = None,
+) -> List[Tuple[float, float]]:
+    """Score mutations, masking up to `batch_size` positions in a single forward pass.
+
+    Mutations at the same position share the same output probabilities. See `get_masked_probas`
+    for a description of the remaining arguments.
 
-    x = x.clone()
+    Returns:
+        Probability of the wild-type and the mutant residue for every mutation in `mutations`.
+    """
+    aa_idxs_list = [_get_aa_idxs(mutation) for mutation in mutations]
+    mutation_idxs = [int(mutation.residue_id) - 1 for mutation in mutations]
+    positions = list(dict.fromkeys(mutation_idxs))
 
-    wt_aa_idx = (
-        proteinsolver.utils.seq_to_tensor(mutation.residue_wt.encode("ascii")).astype(int).item()
+    probas_list = get_masked_probas(
+        net,
+        x,
+        edge_index,
+        edge_attr,
+        [[position] for position in positions],
+        num_categories=num_categories,
+        batch_size=batch_size,
+        num_hops=num_hops,
     )
-    mutation_idx = int(mutation.residue_id) - 1
-    mut_aa_idx = (
-        proteinsolver.utils.seq_to_tensor(mutation.residue_mut.encode("ascii")).astype(int).item()
+    probas_by_position = {position: probas[0] for position, probas in zip(positions, probas_list)}
+
+    return [
+        (
+            probas_by_position[mutation_idx][wt_aa_idx].item(),
+            probas_by_position[mutation_idx][mut_aa_idx].item(),
+        )
+        for mutation_idx, (wt_aa_idx, mut_aa_idx) in zip(mutation_idxs, aa_idxs_list)
+    ]
+
+
+def get_mutation_set_scores(
+    net: nn.Module,
+    x: torch.Tensor,
+    edge_index: torch.Tensor,
+    edge_attr: torch.Tensor,
+    mutation_sets: List[List[Mutation]],
+    num_categories: int = 20,
+    batch_size: int = 1,
+    num_hops: Optional[int] = None,
+) -> List[Tuple[List[float], List[float]]]:
+    """Score sets of mutations, masking all positions in a set at the same time.
+
+    Every set requires a single forward pass, and up to `batch_size` sets are evaluated together.
+    Sets that mutate the same positions share the same output probabilities. See
+    `get_masked_probas` for a description of the remaining arguments.
+
+    Returns:
+        Probabilities of the wild-type and the mutant residues at every position in every set.
+    """
+    position_sets = []
+    for mutation_set in mutation_sets:
+        positions = [int(mutation.residue_id) - 1 for mutation in mutation_set]
+        assert len(set(positions)) == len(positions)
+        position_sets.append(tuple(positions))
+    unique_position_sets = list(dict.fromkeys(position_sets))
+
+    probas_list = get_masked_probas(
+        net,
+        x,
+        edge_index,
+        edge_attr,
+        unique_position_sets,
+        num_categories=num_categories,
+        batch_size=batch_size,
+        num_hops=num_hops,
     )
+    probas_by_position_set = dict(zip(unique_position_sets, probas_list))
+
+    scores_list = []
+    for mutation_set, positions in zip(mutation_sets, position_sets):
+        probas = probas_by_position_set[positions]
+        aa_idxs_list = [_get_aa_idxs(mutation) for mutation in mutation_set]
+        scores_wt = [probas[i, wt_aa_idx].item() for i, (wt_aa_idx, _) in enumerate(aa_idxs_list)]
+        scores_mut = [
+            probas[i, mut_aa_idx].item() for i, (_, mut_aa_idx) in enumerate(aa_idxs_list)
+        ]
+        scores_list.append((scores_wt, scores_mut))
+    return scores_list
+
+
+def get_masked_probas(
+    net: nn.Module,
+    x: torch.Tensor,
+    edge_index: torch.Tensor,
+    edge_attr: torch.Tensor,
+    position_sets: List[Sequence[int]],
+    num_categories: int = 20,
+    batch_size: int = 1,
+    num_hops: Optional[int] = None,
+) -> List[torch.Tensor]:
+    """Return the probability of every amino acid at masked positions.
+
+    Every set of positions is masked in its own copy of the graph, and up to `batch_size` copies
+    are combined into a single block-diagonal graph by offsetting their node indices.
+
+    Args:
+        position_sets: Sets of positions that should be masked together.
+        num_hops: If provided, each copy contains only the nodes within `num_hops` hops of the
+            masked positions. This gives the same scores as the full graph as long as `num_hops`
+            is not smaller than the number of graph convolution layers in `net`.
+
+    Returns:
+        Tensor of shape `[len(positions), num_categories]` for every set in `position_sets`.
+    """
+    # Compact data stores edge indices as int32, which older versions of torch can not index
+    # with. Cast them once here, so that neither `get_k_hop_subgraph` nor `net` copy them for
+    # every set of positions.
+    edge_index = edge_index.long()
+
+    probas_list = []
+    for start in range(0, len(position_sets), batch_size):
+        batch_position_sets = position_sets[start : start + batch_size]
+
+        x_list, edge_index_list, edge_attr_list, masked_nodes = [], [], [], []
+        num_batch_nodes = 0
+        for positions in batch_position_sets:
+            if num_hops is None:
+                subgraph = (x, edge_index, edge_attr, list(positions))
+            else:
+                subset, edge_index_sub, edge_mask, positions_sub = get_k_hop_subgraph(
+                    list(positions), num_hops, edge_index, x.size(0)
+                )
+                subgraph = (x[subset], edge_index_sub, edge_attr[edge_mask], positions_sub)
+            x_sub, edge_index_sub, edge_attr_sub, positions_sub = subgraph
+            x_list.append(x_sub)
+            edge_index_list.append(
+                edge_index_sub + num_batch_nodes if num_batch_nodes else edge_index_sub
+            )
+            edge_attr_list.append(edge_attr_sub)
+            masked_nodes.extend(num_batch_nodes + position for position in positions_sub)
+            num_batch_nodes += x_sub.size(0)
+
+        # For a single copy of the full graph, this is the only tensor that is allocated
+        x_batch = torch.cat(x_list)
+        x_batch[masked_nodes] = num_categories
+        if len(batch_position_sets) == 1:
+            edge_index_batch, edge_attr_batch = edge_index_list[0], edge_attr_list[0]
+        else:
+            edge_index_batch = torch.cat(edge_index_list, dim=1)
+            edge_attr_batch = torch.cat(edge_attr_list)
+
+        with InferenceRuntime.inference():
+            output = net(x_batch, edge_index_batch, edge_attr_batch)
+            batch_probas = torch.softmax(output[masked_nodes], dim=1).cpu()
+
+        probas_list.extend(
+            torch.split(batch_probas, [len(positions) for positions in batch_position_sets])
+        )
+    return probas_list
+
+
+def get_k_hop_subgraph(
+    node_idx: Union[int, List[int]], num_hops: int, edge_index: torch.Tensor, num_nodes: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Union[int, List[int]]]:
+    """Extract the subgraph induced by all nodes within `num_hops` hops of `node_idx`.
+
+    Messages flow from `edge_index[1]` to `edge_index[0]`, so the neighbourhood is expanded
+    from the nodes in `edge_index[0]` to the nodes in `edge_index[1]`. The order of edges
+    is preserved.
+
+    Args:
+        node_idx: Index of the central node, or a list of indices of central nodes.
+
+    Returns:
+        Indices of the nodes in the subgraph, edge index of the subgraph (relabelled to the
+        positions of nodes in the subgraph), mask of the edges that are kept, and the position(s)
+        of `node_idx` in the subgraph.
+    """
+    # Compact data stores edge indices as int32, which older versions of torch can not index with.
+    # This does not copy `edge_index` if it is already int64.
+    row, col = edge_index = edge_index.long()
+    node_mask = torch.zeros(num_nodes, dtype=torch.bool, device=edge_index.device)
+    node_mask[node_idx] = True
+    for _ in range(num_hops):
+        node_mask[col[node_mask[row]]] = True
+
+    edge_mask = node_mask[row] & node_mask[col]
+    subset = torch.nonzero(node_mask, as_tuple=True)[0]
+    node_map = torch.full((num_nodes,), -1, dtype=torch.long, device=edge_index.device)
+    node_map[subset] = torch.arange(subset.size(0), device=edge_index.device)
+    node_idx_sub = node_map[node_idx]
+    return (
+        subset,
+        node_map[edge_index[:, edge_mask]],
+        edge_mask,
+        int(node_idx_sub) if isinstance(node_idx, int) else node_idx_sub.tolist(),
+    )
+
+
+def _get_aa_idxs(mutation: Mutation) -> Tuple[int, int]:
+    wt_aa_idx, mut_aa_idx = _get_aa_idx(mutation.residue_wt), _get_aa_idx(mutation.residue_mut)
     assert wt_aa_idx != mut_aa_idx
+    return wt_aa_idx, mut_aa_idx
 
-    x[mutation_idx] = num_categories
 
-    with torch.no_grad():
-        output = net(x, edge_index, edge_attr)
-        output = torch.softmax(output, dim=1)
+@functools.lru_cache(maxsize=None)
+def _get_aa_idx(aa: str) -> int:
+    """Return the index of amino acid `aa` in the ProteinSolver vocabulary.
 
-    score_wt = output[mutation_idx][wt_aa_idx].item()
-    score_mut = output[mutation_idx][mut_aa_idx].item()
+    Indices are looked up once per amino acid, so `proteinsolver` is not imported for every
+    analyzed mutation.
+    """
+    import proteinsolver
 
-    return score_wt, score_mut
+    return proteinsolver.utils.seq_to_tensor(aa.encode("ascii")).astype(int).item()
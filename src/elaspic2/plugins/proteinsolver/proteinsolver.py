@@ -1,27 +1,75 @@
 import importlib
 from pathlib import Path
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 import torch.nn as nn
 from kmbio import PDB
 from kmtools.structure_tools.types import DomainMutation as Mutation
 
-from elaspic2.core import MutationAnalyzer, StructureTool
-from elaspic2.plugins.proteinsolver.protein_data import extract_seq_and_adj, get_mutation_score
+from elaspic2.core import (
+    InferenceRuntime,
+    MutationAnalyzer,
+    StructureTool,
+    assign_weights,
+    load_weights_cached,
+    skip_init_weights,
+)
+from elaspic2.plugins.proteinsolver.protein_data import (
+    extract_seq_and_adj,
+    get_mutation_scores,
+    get_mutation_set_scores,
+)
 from elaspic2.plugins.proteinsolver.types import ProteinSolverData
 
 
 class ProteinSolver(StructureTool, MutationAnalyzer):
     model: Optional[nn.Module] = None
     device: Optional[torch.device] = None
+    # Number of graph convolution layers in `model`, which bounds its receptive field
+    num_hops: Optional[int] = None
+    # Whether `model` accepts int32 edge indices and float16 edge attributes
+    accepts_compact_data: bool = False
     is_loaded: bool = False
 
     @classmethod
-    def load_model(cls, model_name="ps_191f05de", device=torch.device("cpu")) -> None:
-        # Need to import proteinsolver in order for the torch_geometric.utils.scatter_ monkeypatch
-        # to be applied.
-        import proteinsolver  # noqa
+    def load_model(
+        cls,
+        model_name="ps_191f05de",
+        device=torch.device("cpu"),
+        mmap_weights: bool = False,
+        edge_chunk_size: Optional[int] = None,
+        inference_model: bool = True,
+        script: bool = False,
+    ) -> None:
+        """Load the ProteinSolver model.
+
+        Args:
+            model_name: Name of the model to load.
+            device: Device on which the model should be evaluated.
+            mmap_weights: Whether to memory-map the model weights, so that workers on the same node
+                share a single copy. Only supported on CPU.
+            edge_chunk_size: If provided, the model processes at most this many edges at a time.
+                This bounds the memory required to evaluate large complexes: activations take
+                about 6 KiB per edge in a chunk, plus 512 bytes per edge in the graph.
+            inference_model: Whether to use the inference-only implementation of the model,
+                which gives the same results as the original model but runs faster and does not
+                require importing `proteinsolver`.
+            script: Whether to compile the inference-only model using `torch.jit.script`.
+        """
+        if mmap_weights and device.type != "cpu":
+            raise ValueError("Memory-mapped weights are only supported on CPU.")
+        if script and not inference_model:
+            raise ValueError("Only the inference-only model can be compiled.")
+
+        if not InferenceRuntime.is_configured:
+            InferenceRuntime.configure()
+
+        if not inference_model:
+            # Need to import proteinsolver in order for the torch_geometric.utils.scatter_
+            # monkeypatch to be applied.
+            import proteinsolver  # noqa
 
         state_file = (
             Path(__file__)
@@ -29,17 +77,38 @@ class ProteinSolver(StructureTool, MutationAnalyzer):
             .resolve(strict=True)
             .as_posix()
         )
-        module = importlib.import_module(f"elaspic2.plugins.proteinsolver.data.{model_name}.model")
-        model = module.Net(  # type: ignore
-            x_input_size=21, adj_input_size=2, hidden_size=128, output_size=20
+        module = importlib.import_module(
+            f"elaspic2.plugins.proteinsolver.data.{model_name}."
+            + ("inference_model" if inference_model else "model")
         )
-        model.load_state_dict(torch.load(state_file, map_location=device))
+
+        def create_model():
+            return module.Net(  # type: ignore
+                x_input_size=21, adj_input_size=2, hidden_size=128, output_size=20
+            )
+
+        if mmap_weights:
+            with skip_init_weights():
+                model = create_model()
+            state_dict = load_weights_cached(
+                state_file, lambda: torch.load(state_file, map_location="cpu")
+            )
+            assign_weights(model, state_dict)
+        else:
+            model = create_model()
+            model.load_state_dict(torch.load(state_file, map_location=device))
+        model.edge_chunk_size = edge_chunk_size
         model = model.eval().to(device)
         for param in model.parameters():
             param.requires_grad = False
+        num_hops = 1 + len(model.graph_conv)
+        if script:
+            model = torch.jit.script(model)
 
         cls.model = model
         cls.device = device
+        cls.num_hops = num_hops
+        cls.accepts_compact_data = inference_model
         cls.is_loaded = True
 
     @classmethod
@@ -49,7 +118,23 @@ class ProteinSolver(StructureTool, MutationAnalyzer):
         protein_sequence: str,
         ligand_sequence: Optional[str],
         remove_hetatms=True,
+        edge_attr_dtype: torch.dtype = torch.float32,
     ) -> ProteinSolverData:
+        """
+        Args:
+            structure_file: Structure of the protein to be mutated.
+            protein_sequence: Sequence of the protein to be mutated.
+            ligand_sequence: Sequence of the interacting protein, if any.
+            remove_hetatms: Whether to remove unknown residues ("X") from the sequences.
+            edge_attr_dtype: Data type used to store edge attributes. Use `torch.float16` to
+                halve the memory they take up, at the cost of a change in scores of up to about
+                1e-3. Only the inference-only model evaluates half-precision edge attributes
+                without first converting the whole tensor back to single precision.
+
+        Returns:
+            Graph of the structure, placed on the device of the loaded model. Edge indices are
+            stored as int32.
+        """
         import proteinsolver
 
         structure = PDB.load(structure_file)
@@ -71,26 +156,142 @@ class ProteinSolver(StructureTool, MutationAnalyzer):
         data = proteinsolver.datasets.protein.row_to_data(pdata)
         data = proteinsolver.datasets.protein.transform_edge_attr(data)
 
-        return data
+        device = cls.device if cls.device is not None else torch.device("cpu")
+        return ProteinSolverData(
+            x=data.x.to(device),
+            edge_index=data.edge_index.to(device, torch.int32),
+            edge_attr=data.edge_attr.to(device, edge_attr_dtype),
+        )
 
     @classmethod
     def analyze_mutation(  # type: ignore[override]
-        cls, mutation: str, data: ProteinSolverData
+        cls, mutation: str, data: ProteinSolverData, use_subgraph: bool = False
     ) -> dict:
+        return cls.analyze_mutations([mutation], data, use_subgraph=use_subgraph)[0]
+
+    @classmethod
+    def analyze_mutations(  # type: ignore[override]
+        cls,
+        mutations: List[str],
+        data: ProteinSolverData,
+        batch_size: int = 1,
+        use_subgraph: bool = False,
+    ) -> List[dict]:
+        """Analyze multiple mutations in the same protein.
+
+        Args:
+            mutations: Mutations to analyze.
+            data: Output of `ProteinSolver.build`.
+            batch_size: Maximum number of positions to mask in a single forward pass.
+                Each position adds a full copy of the graph to the batch, so memory use grows
+                linearly with the batch size. The default keeps the peak memory of evaluating
+                a single mutation; larger values trade memory for speed.
+            use_subgraph: Whether to evaluate each mutation using only the residues that are
+                within the receptive field of the model (`ProteinSolver.num_hops` hops) around
+                the mutated residue. This gives the same scores as the full graph, but makes
+                the cost of each mutation independent of the size of the structure.
+
+        Returns:
+            One dictionary of scores for every mutation in `mutations`.
+        """
         if cls.model is None:
             raise Exception(
                 "You need to call `ProteinSolver.load_model()` before evaluating mutations."
             )
 
-        mut = Mutation.from_string(mutation)
+        mut_list = [Mutation.from_string(mutation) for mutation in mutations]
 
-        data = data.to(cls.device)  # type: ignore
+        x, edge_index, edge_attr = cls._get_model_inputs(data)
 
-        score_wt, score_mut = get_mutation_score(
-            cls.model, data.x, data.edge_index, data.edge_attr, mut
+        scores_list = get_mutation_scores(
+            cls.model,
+            x,
+            edge_index,
+            edge_attr,
+            mut_list,
+            batch_size=batch_size,
+            num_hops=cls.num_hops if use_subgraph else None,
         )
 
-        return {"score_wt": score_wt, "score_mut": score_mut}
+        return [
+            {"score_wt": score_wt, "score_mut": score_mut} for score_wt, score_mut in scores_list
+        ]
+
+    @classmethod
+    def analyze_mutation_sets(
+        cls,
+        mutation_sets: List[List[str]],
+        data: ProteinSolverData,
+        batch_size: int = 1,
+        use_subgraph: bool = False,
+    ) -> List[dict]:
+        """Analyze sets of mutations that are introduced together (e.g. double mutants).
+
+        All positions in a set are masked at the same time, so every set requires a single
+        forward pass through the model.
+
+        Args:
+            mutation_sets: Sets of mutations to analyze. Mutations in a set must be at
+                different positions.
+            data: Output of `ProteinSolver.build`.
+            batch_size: Maximum number of sets to evaluate in a single forward pass.
+                Each set adds a full copy of the graph to the batch, so the default keeps
+                the peak memory of evaluating a single set.
+            use_subgraph: Whether to evaluate each set using only the residues that are within
+                the receptive field of the model around the mutated residues.
+
+        Returns:
+            One dictionary for every set in `mutation_sets`, containing the probabilities of
+            the wild-type and mutant residues at every position (`scores_wt`, `scores_mut`),
+            and their products (`score_wt`, `score_mut`).
+        """
+        if cls.model is None:
+            raise Exception(
+                "You need to call `ProteinSolver.load_model()` before evaluating mutations."
+            )
+
+        mut_sets = []
+        for mutation_set in mutation_sets:
+            mut_set = [Mutation.from_string(mutation) for mutation in mutation_set]
+            if len({mut.residue_id for mut in mut_set}) != len(mut_set):
+                raise ProteinSolverAnalyzeError(
+                    f"Mutations in a set must be at different positions ({mutation_set})."
+                )
+            mut_sets.append(mut_set)
+
+        x, edge_index, edge_attr = cls._get_model_inputs(data)
+
+        scores_list = get_mutation_set_scores(
+            cls.model,
+            x,
+            edge_index,
+            edge_attr,
+            mut_sets,
+            batch_size=batch_size,
+            num_hops=cls.num_hops if use_subgraph else None,
+        )
+
+        return [
+            {
+                "score_wt": float(np.prod(scores_wt)),
+                "score_mut": float(np.prod(scores_mut)),
+                "scores_wt": scores_wt,
+                "scores_mut": scores_mut,
+            }
+            for scores_wt, scores_mut in scores_list
+        ]
+
+    @classmethod
+    def _get_model_inputs(
+        cls, data: ProteinSolverData
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        x, edge_index, edge_attr = (
+            tensor.to(cls.device) for tensor in [data.x, data.edge_index, data.edge_attr]
+        )
+        # Edge indices are cast to int64 once per call by `get_masked_probas`
+        if not cls.accepts_compact_data:
+            edge_attr = edge_attr.float()
+        return x, edge_index, edge_attr
 
 
 class ProteinSolverBuildError(Exception):
@@ -4,6 +4,10 @@ import torch
 
 
 class ProteinSolverData(NamedTuple):
+    # Amino acid index of every residue
     x: torch.Tensor
+    # Pairs of residues within the distance cutoff, stored as int32 by `ProteinSolver.build`
     edge_index: torch.Tensor
+    # Features of every pair of residues, stored as float32 unless `ProteinSolver.build` is asked
+    # to store them as float16
     edge_attr: torch.Tensor
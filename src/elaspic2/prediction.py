@@ -0,0 +1,386 @@
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import lightgbm as lgb
+import numpy as np
+from sklearn.decomposition import PCA
+
+__all__ = ["FeatureColumns", "FeatureDeltaPlan", "PCAProjection", "LightGBMEnsemble"]
+
+# Values of `missing_type` in LightGBM model dumps
+_MISSING_TYPES = {"None": 0, "Zero": 1, "NaN": 2}
+# Absolute values up to this threshold are treated as zero by LightGBM
+_ZERO_THRESHOLD = 1e-35
+# Regression and ranking objectives for which `lgb.Booster.predict` returns the raw sum of
+# the trees, without transforming it
+_RAW_OUTPUT_OBJECTIVES = {
+    "regression",
+    "regression_l1",
+    "huber",
+    "fair",
+    "quantile",
+    "mape",
+    "lambdarank",
+    "rank_xendcg",
+}
+
+
+class FeatureColumns(Dict[str, np.ndarray]):
+    """Features of a batch of mutations, stored column by column.
+
+    Features collected from records are stored as 1-D float32 arrays (scalars) or contiguous
+    2-D float32 arrays (embeddings), with one row for every mutation. Model outputs are float32,
+    so this does not change their values. Differences between features are stored in double
+    precision (see `FeatureDeltaPlan`).
+    """
+
+    @classmethod
+    def from_records(
+        cls, records: Sequence[Mapping[str, Any]], columns: Optional[Collection[str]] = None
+    ) -> "FeatureColumns":
+        """Collect features returned by `ELASPIC2.analyze_mutation` into columns.
+
+        Args:
+            records: Features of every mutation.
+            columns: Columns to collect. Other keys of the records, which do not have to be
+                numeric, are ignored. By default, all keys are collected.
+        """
+        if not records:
+            return cls()
+        return cls(
+            {
+                column: np.array([record[column] for record in records], dtype=np.float32)
+                for column in records[0]
+                if columns is None or column in columns
+            }
+        )
+
+    @classmethod
+    def iter_chunks(
+        cls,
+        items: Iterable[Union[Mapping[str, Any], "FeatureColumns"]],
+        chunk_size: int,
+        columns: Optional[Collection[str]] = None,
+    ) -> Iterator["FeatureColumns"]:
+        """Group a stream of feature records into chunks of up to `chunk_size` rows.
+
+        `FeatureColumns` in `items` are yielded as they are, after any pending records.
+        See `from_records` for a description of `columns`.
+        """
+        records: List[Mapping[str, Any]] = []
+        for item in items:
+            if isinstance(item, FeatureColumns):
+                if records:
+                    yield cls.from_records(records, columns)
+                    records = []
+                yield item
+                continue
+            records.append(item)
+            if len(records) >= chunk_size:
+                yield cls.from_records(records, columns)
+                records = []
+        if records:
+            yield cls.from_records(records, columns)
+
+    @property
+    def num_rows(self) -> int:
+        return len(next(iter(self.values()))) if self else 0
+
+    def to_matrix(self, columns: List[str], dtype: np.dtype = np.float32) -> np.ndarray:
+        """Return a 2-D array with the scalar features listed in `columns`."""
+        matrix = np.empty((self.num_rows, len(columns)), dtype=dtype)
+        for i, column in enumerate(columns):
+            matrix[:, i] = self[column]
+        return matrix
+
+
+class FeatureDeltaPlan:
+    """Differences between features which are required to calculate `columns`.
+
+    Columns ending in `_change` are the difference between the `_mut` and the `_wt` features,
+    and `_core2interface_` columns are the difference between the `_interface_` and the `_core_`
+    features. The plan is compiled once, and lists only the differences that are needed,
+    in the order in which they have to be calculated.
+
+    Differences are calculated in double precision, as they were when features were stored in
+    a DataFrame of Python floats, so that values close to LightGBM thresholds are not rounded
+    to the other side of the threshold.
+    """
+
+    def __init__(self, columns: Iterable[str]):
+        # (output column, minuend column, subtrahend column)
+        self.deltas: List[Tuple[str, str, str]] = []
+        # Columns which have to be provided in order to calculate `columns`
+        self.input_columns: List[str] = []
+        self._delta_columns: set = set()
+        for column in columns:
+            self._add_column(column)
+
+    def apply(self, features: FeatureColumns) -> FeatureColumns:
+        """Return a copy of `features` with all differences added to it."""
+        features = FeatureColumns(features)
+        for column, column_a, column_b in self.deltas:
+            features[column] = np.subtract(features[column_a], features[column_b], dtype=np.float64)
+        return features
+
+    def _add_column(self, column: str) -> None:
+        if column in self._delta_columns:
+            return
+        if "_core2interface_" in column:
+            column_a = column.replace("_core2interface_", "_interface_")
+            column_b = column.replace("_core2interface_", "_core_")
+        elif column.endswith("_change"):
+            column_a = column[: -len("_change")] + "_mut"
+            column_b = column[: -len("_change")] + "_wt"
+        else:
+            if column not in self.input_columns:
+                self.input_columns.append(column)
+            return
+        self._add_column(column_a)
+        self._add_column(column_b)
+        self.deltas.append((column, column_a, column_b))
+        self._delta_columns.add(column)
+
+
+class PCAProjection:
+    """Project embeddings onto the principal components used by the LightGBM models.
+
+    All PCA models of a COI are compiled into one stack of projection matrices, so that every
+    embedding column is projected once, no matter how many LightGBM models consume the
+    projections. Only components listed in `feature_columns` are computed.
+    """
+
+    def __init__(self, pca_models: Mapping[str, PCA], feature_columns: List[str]):
+        """
+        Args:
+            pca_models: PCA model for every embedding column.
+            feature_columns: Columns required by the LightGBM models.
+        """
+        feature_columns_set = set(feature_columns)
+        self.columns: List[str] = []
+        self.output_columns: List[List[str]] = []
+        components_list = []
+        means = []
+        for column, pca_model in pca_models.items():
+            if pca_model.whiten:
+                raise PCAProjectionError(f"Whitened PCA models are not supported ({column}).")
+            idxs = [
+                i
+                for i in range(pca_model.n_components_)
+                if f"{column}_{i}_pc" in feature_columns_set
+            ]
+            if not idxs:
+                continue
+            self.columns.append(column)
+            self.output_columns.append([f"{column}_{i}_pc" for i in idxs])
+            components_list.append(pca_model.components_[idxs])
+            means.append(pca_model.mean_)
+
+        # Pad projection matrices to the same number of components so that they can be stacked
+        num_components = max((len(c) for c in components_list), default=0)
+        num_features = max((c.shape[1] for c in components_list), default=0)
+        self.components = np.zeros((len(self.columns), num_features, num_components))
+        for i, components in enumerate(components_list):
+            self.components[i, :, : len(components)] = components.T
+        # Offset applied after the projection, equivalent to centering the inputs beforehand
+        self.offsets = np.matmul(np.stack(means)[:, None, :], self.components) if means else None
+
+    def transform(self, arrays: Mapping[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Project embeddings onto their principal components.
+
+        Args:
+            arrays: 2-D array of embeddings for every column in `self.columns`.
+
+        Returns:
+            1-D array of values for every principal component used by the LightGBM models.
+        """
+        if not self.columns:
+            return {}
+        # Columns are projected one at a time, into a preallocated output, so that only one
+        # column is converted to double precision at any given time
+        num_rows = len(arrays[self.columns[0]])
+        values_out = np.empty((len(self.columns), num_rows, self.components.shape[2]))
+        for i, column in enumerate(self.columns):
+            np.matmul(arrays[column], self.components[i], out=values_out[i])
+        values_out -= self.offsets
+        return {
+            output_column: values_out[i, :, j]
+            for i, output_columns in enumerate(self.output_columns)
+            for j, output_column in enumerate(output_columns)
+        }
+
+
+class LightGBMEnsemble:
+    """Average the predictions of several LightGBM models using vectorized NumPy operations.
+
+    The trees of all models are compiled into flat node arrays, and all trees are evaluated at
+    once, moving every (mutation, tree) pair one level down its tree per step until every pair
+    reaches a leaf. Trees are summed in the same order and in the same precision as in LightGBM,
+    so predictions are identical to the mean of `lgb.Booster.predict`.
+    """
+
+    def __init__(self, lgb_models: Sequence[lgb.Booster], chunk_size: int = 256):
+        """
+        Args:
+            lgb_models: LightGBM models with the same features and numerical splits only.
+            chunk_size: Number of mutations that are evaluated at once. Small chunks keep
+                intermediate arrays in the CPU cache.
+        """
+        self.chunk_size = chunk_size
+        model_dumps = [lgb_model.dump_model() for lgb_model in lgb_models]
+        if not model_dumps:
+            raise LightGBMEnsembleError("At least one model is required.")
+        self.feature_names: List[str] = model_dumps[0]["feature_names"]
+
+        nodes: List[dict] = []
+        roots = []
+        self.num_trees: List[int] = []
+        for model_dump in model_dumps:
+            if model_dump["feature_names"] != self.feature_names:
+                raise LightGBMEnsembleError("All models must use the same features.")
+            # Objectives are stored with their options, e.g. "regression sqrt"
+            objective, *objective_options = model_dump.get("objective", "").split()
+            if (
+                objective not in _RAW_OUTPUT_OBJECTIVES
+                or "sqrt" in objective_options
+                or model_dump["num_tree_per_iteration"] != 1
+                or model_dump.get("average_output")
+            ):
+                raise LightGBMEnsembleError("Only regression and ranking models are supported.")
+            for tree_info in model_dump["tree_info"]:
+                roots.append(self._add_node(nodes, tree_info["tree_structure"]))
+            self.num_trees.append(len(model_dump["tree_info"]))
+
+        self.roots = np.array(roots, dtype=np.intp)
+        self.is_leaf = np.array(["leaf_value" in node for node in nodes])
+        self.value = np.array([node.get("leaf_value", 0.0) for node in nodes])
+        self.feature = np.array([node.get("split_feature", 0) for node in nodes], dtype=np.intp)
+        self.threshold = np.array([node.get("threshold", 0.0) for node in nodes])
+        self.missing_type = np.array(
+            [_MISSING_TYPES[node.get("missing_type", "None")] for node in nodes], dtype=np.int8
+        )
+        self.default_left = np.array([node.get("default_left", False) for node in nodes])
+        # Right and left child of every node, next to each other; leaves point to themselves
+        self.children = np.array(
+            [
+                [node.get("right", node_idx), node.get("left", node_idx)]
+                for node_idx, node in enumerate(nodes)
+            ],
+            dtype=np.intp,
+        ).ravel()
+        self.has_missing_values = bool((self.missing_type != _MISSING_TYPES["None"]).any())
+
+    def predict(self, feature_matrix: np.ndarray) -> np.ndarray:
+        """Return the mean prediction of all models for every row in `feature_matrix`."""
+        if feature_matrix.ndim != 2 or feature_matrix.shape[1] != len(self.feature_names):
+            raise LightGBMEnsembleError(
+                f"Expected a matrix with {len(self.feature_names)} columns, "
+                f"got an array of shape {feature_matrix.shape}."
+            )
+        predictions = np.empty(len(feature_matrix))
+        for start in range(0, len(feature_matrix), self.chunk_size):
+            end = start + self.chunk_size
+            predictions[start:end] = self._predict_chunk(feature_matrix[start:end])
+        return predictions
+
+    def _predict_chunk(self, feature_matrix: np.ndarray) -> np.ndarray:
+        # LightGBM compares features to thresholds in double precision
+        feature_matrix = feature_matrix.astype(np.float64)
+        # LightGBM treats values within `_ZERO_THRESHOLD` of zero as exactly zero
+        feature_matrix[np.abs(feature_matrix) <= _ZERO_THRESHOLD] = 0.0
+        if not self.has_missing_values:
+            # Without a missing value type, LightGBM treats NaNs as zeros
+            feature_matrix[np.isnan(feature_matrix)] = 0.0
+        num_rows, num_features = feature_matrix.shape
+        feature_values = feature_matrix.ravel()
+
+        # Evaluate (mutation, tree) pairs which have not reached a leaf yet. Leaves point to
+        # themselves, so pairs are only removed once at least half of them have reached a leaf.
+        leaf_nodes = np.tile(self.roots, num_rows)
+        positions = np.flatnonzero(~self.is_leaf.take(leaf_nodes))
+        nodes = leaf_nodes.take(positions)
+        row_offsets = positions // len(self.roots) * num_features
+        while len(positions):
+            values = feature_values.take(row_offsets + self.feature.take(nodes))
+            go_left = values <= self.threshold.take(nodes)
+            if self.has_missing_values:
+                go_left = self._apply_missing_values(nodes, values, go_left)
+            nodes = self.children.take(2 * nodes + go_left)
+
+            is_split = ~self.is_leaf.take(nodes)
+            num_split = np.count_nonzero(is_split)
+            if num_split <= len(nodes) // 2:
+                leaf_nodes[positions] = nodes
+                split_idxs = np.flatnonzero(is_split)
+                positions, nodes, row_offsets = (
+                    positions.take(split_idxs),
+                    nodes.take(split_idxs),
+                    row_offsets.take(split_idxs),
+                )
+
+        # Cumulative sums add up trees one at a time, in the same order as LightGBM
+        leaf_values = self.value.take(leaf_nodes).reshape(num_rows, len(self.roots))
+        predictions = []
+        for start, end in zip(np.cumsum([0] + self.num_trees), np.cumsum(self.num_trees)):
+            if start == end:
+                predictions.append(np.zeros(num_rows))
+            else:
+                predictions.append(np.cumsum(leaf_values[:, start:end], axis=1)[:, -1])
+        return np.mean(predictions, axis=0)
+
+    def _apply_missing_values(
+        self, nodes: np.ndarray, values: np.ndarray, go_left: np.ndarray
+    ) -> np.ndarray:
+        """Follow LightGBM's rules for features which are NaN or, for some splits, zero."""
+        missing_type = self.missing_type[nodes]
+        is_nan = np.isnan(values)
+        # NaNs are treated as zeros, unless the split has a separate path for NaNs
+        is_zero = (np.abs(values) <= _ZERO_THRESHOLD) | (
+            is_nan & (missing_type != _MISSING_TYPES["NaN"])
+        )
+        go_left = np.where(is_nan, 0.0 <= self.threshold[nodes], go_left)
+        is_missing = ((missing_type == _MISSING_TYPES["Zero"]) & is_zero) | (
+            (missing_type == _MISSING_TYPES["NaN"]) & is_nan
+        )
+        return np.where(is_missing, self.default_left[nodes], go_left)
+
+    @classmethod
+    def _add_node(cls, nodes: List[dict], node: dict) -> int:
+        """Add `node` and its descendants to `nodes` and return the index of `node`."""
+        node_idx = len(nodes)
+        if "leaf_value" in node:
+            nodes.append({"leaf_value": node["leaf_value"]})
+            return node_idx
+
+        if node["decision_type"] != "<=":
+            raise LightGBMEnsembleError(f"Unsupported decision type: '{node['decision_type']}'.")
+        nodes.append(
+            {
+                "split_feature": node["split_feature"],
+                "threshold": node["threshold"],
+                "missing_type": node["missing_type"],
+                "default_left": node["default_left"],
+            }
+        )
+        nodes[node_idx]["left"] = cls._add_node(nodes, node["left_child"])
+        nodes[node_idx]["right"] = cls._add_node(nodes, node["right_child"])
+        return node_idx
+
+
+class PCAProjectionError(Exception):
+    pass
+
+
+class LightGBMEnsembleError(Exception):
+    pass
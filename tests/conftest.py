@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+
+
+def get_mapped_weights_ranges():
+    """Return the address ranges of all memory-mapped weight stores."""
+    ranges = []
+    with open("/proc/self/maps") as fin:
+        for line in fin:
+            fields = line.split()
+            if len(fields) >= 6 and fields[5].endswith(".weights"):
+                start, end = (int(address, 16) for address in fields[0].split("-"))
+                ranges.append((start, end))
+    return ranges
+
+
+@pytest.fixture
+def assert_parameters_mapped():
+    """Return a function checking that all parameters of a model are memory-mapped weights."""
+    if not Path("/proc/self/maps").is_file():
+        pytest.skip("Requires /proc/self/maps.")
+
+    def assert_parameters_mapped(model):
+        ranges = get_mapped_weights_ranges()
+        for name, param in model.named_parameters():
+            assert any(start <= param.data_ptr() < end for start, end in ranges), name
+
+    return assert_parameters_mapped
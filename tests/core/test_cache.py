@@ -0,0 +1,43 @@
+from elaspic2.core import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_lru_cache_getsizeof():
+    cache = LRUCache(maxsize=10, getsizeof=len)
+    cache.put("a", "x" * 4)
+    cache.put("b", "x" * 4)
+    cache.put("c", "x" * 4)
+    assert "a" not in cache
+    assert cache.currsize == 8
+    # Values larger than the cache are not stored
+    cache.put("d", "x" * 11)
+    assert "d" not in cache
+    assert cache.currsize == 8
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.currsize == 0
+
+
+def test_lru_cache_replace():
+    cache = LRUCache(maxsize=10, getsizeof=len)
+    cache.put("a", "x" * 4)
+    cache.put("b", "x" * 4)
+    cache.put("a", "x" * 2)
+    assert cache.currsize == 6
+    assert cache.get("a") == "xx"
+    # Replacing a value marks it as most recently used
+    cache.put("c", "x" * 6)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.currsize == 8
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from elaspic2.core import InferenceConfig, InferenceRuntime, inference
+from elaspic2.core.inference import parse_cpu_list
+
+
+@pytest.mark.parametrize(
+    "cpu_list, cpus_", [("0", (0,)), ("0-3", (0, 1, 2, 3)), ("0-1,4,6-7", (0, 1, 4, 6, 7))]
+)
+def test_parse_cpu_list(cpu_list, cpus_):
+    assert parse_cpu_list(cpu_list) == cpus_
+
+
+def test_inference_config_from_env(monkeypatch):
+    monkeypatch.setenv("ELASPIC2_NUM_THREADS", "2")
+    monkeypatch.setenv("ELASPIC2_CPU_AFFINITY", "0-1")
+    monkeypatch.delenv("ELASPIC2_NUM_INTEROP_THREADS", raising=False)
+    config = InferenceConfig.from_env()
+    assert config == InferenceConfig(num_threads=2, num_interop_threads=None, cpu_affinity=(0, 1))
+
+
+def test_inference_config_for_worker():
+    config = InferenceConfig.for_worker(0, num_threads=1)
+    assert config.num_threads == 1
+    assert len(config.cpu_affinity) == 1
+
+
+def test_inference_config_for_worker_wraps_around(monkeypatch):
+    monkeypatch.setattr(inference, "_get_available_cpus", lambda: {0, 1, 2, 3, 4})
+    assert InferenceConfig.for_worker(1, num_threads=2).cpu_affinity == (2, 3)
+    assert InferenceConfig.for_worker(2, num_threads=2).cpu_affinity == (4, 0)
+    assert InferenceConfig.for_worker(7, num_threads=3).cpu_affinity == (1, 2, 3)
+    assert InferenceConfig.for_worker(7, num_threads=3).num_threads == 3
+    with pytest.raises(ValueError):
+        InferenceConfig.for_worker(0, num_threads=6)
+
+
+def test_inference_runtime_disables_autograd():
+    linear = torch.nn.Linear(4, 4)
+    with InferenceRuntime.inference():
+        output = linear(torch.ones(1, 4))
+    assert InferenceRuntime.is_configured
+    assert not output.requires_grad
@@ -0,0 +1,79 @@
+import torch
+import torch.nn as nn
+
+from elaspic2.core import (
+    assign_weights,
+    load_weights,
+    load_weights_cached,
+    save_weights,
+    skip_init_weights,
+)
+
+
+class TiedModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(10, 4)
+        self.norm = nn.BatchNorm1d(4)
+        self.decoder = nn.Linear(4, 10)
+        self.decoder.weight = self.embedding.weight
+
+
+class InitTiedModel(TiedModel):
+    def __init__(self):
+        super().__init__()
+        self.num_init_calls = 0
+        self.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        self.num_init_calls += 1
+
+
+def test_save_and_load_weights(tmp_path):
+    model = TiedModel()
+    weights_file = tmp_path.joinpath("model.weights")
+    save_weights(model.state_dict(), weights_file)
+
+    state_dict = load_weights(weights_file)
+    assert state_dict.keys() == model.state_dict().keys()
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(state_dict[name], tensor)
+    # Tied weights are stored once
+    assert state_dict["decoder.weight"] is state_dict["embedding.weight"]
+
+
+def test_assign_weights_does_not_copy(tmp_path):
+    source_file = tmp_path.joinpath("model.state")
+    torch.save(TiedModel().state_dict(), source_file)
+
+    state_dict = load_weights_cached(source_file, lambda: torch.load(source_file))
+    assert tmp_path.joinpath("model.weights").is_file()
+
+    model = TiedModel().eval()
+    assign_weights(model, state_dict)
+    assert model.embedding.weight.data_ptr() == state_dict["embedding.weight"].data_ptr()
+    assert model.decoder.weight is model.embedding.weight
+    assert model.norm.running_mean.data_ptr() == state_dict["norm.running_mean"].data_ptr()
+
+    reference_model = TiedModel().eval()
+    reference_model.load_state_dict(torch.load(source_file))
+    x = torch.tensor([[1, 2, 3]])
+    assert torch.equal(
+        model.decoder(model.embedding(x)), reference_model.decoder(reference_model.embedding(x))
+    )
+
+
+def test_skip_init_weights():
+    x = torch.zeros(4, 4)
+    with skip_init_weights(InitTiedModel):
+        nn.init.normal_(x)
+        assert torch.equal(x, torch.zeros(4, 4))
+        model = InitTiedModel()
+    assert model.num_init_calls == 0
+    assert model.decoder.weight is model.embedding.weight
+
+    # Initialization is restored on exit
+    nn.init.normal_(x)
+    assert not torch.equal(x, torch.zeros(4, 4))
+    assert "_init_weights" in vars(InitTiedModel)
+    assert InitTiedModel().num_init_calls > 0
@@ -0,0 +1,321 @@
+import numpy as np
+import pytest
+import torch
+
+import elaspic2.plugins.protbert.data
+from elaspic2.plugins.protbert import ProtBert, ProtBertAnalyzeError, ProtBertBatchScheduler
+from elaspic2.plugins.protbert.protbert import _SCORE_CACHE_ENTRY_OVERHEAD
+
+try:
+    import importlib.resources as importlib_resources
+except ImportError:
+    import importlib_resources
+
+PROTEIN_SEQUENCE = (
+    "GSMEIRVRVEKDPELGFSISGGVGGRGNPFRPDDDGIFVTRVQPEGPASKLLQPGDKIIQANGYSFINIEHGQAVSLLKTFQNTVELII"
+    "VREVSS"
+)
+MUTATIONS = ["G1A", "G1C", "E4L", "E4W", "R6K", "V7A"]
+
+
+@pytest.fixture(scope="module")
+def protbert_data():
+    if not ProtBert.is_loaded:
+        ProtBert.load_model()
+    return ProtBert.build(PROTEIN_SEQUENCE, None)
+
+
+def get_window(data, mut_idx):
+    """Return the sequence passed to the model for a mutation at `mut_idx`."""
+    protein_slice, ligand_slice, window_idx = ProtBert._get_window_slices(data, mut_idx)
+    return data.sequence[protein_slice] + data.sequence[ligand_slice], window_idx
+
+
+def assert_results_match(results, results_ref):
+    assert len(results) == len(results_ref)
+    for result, result_ref in zip(results, results_ref):
+        assert result.keys() == result_ref.keys()
+        for key in result:
+            np.testing.assert_allclose(result[key], result_ref[key], rtol=1e-4, atol=1e-5)
+
+
+@pytest.fixture
+def model_calls(monkeypatch):
+    """Record the token ids of every `ProtBert._run_model` call, and whether it returned logits."""
+    calls = []
+    run_model = ProtBert._run_model
+
+    def run_model_recorded(input_ids, logits_positions=None, attention_mask=None):
+        calls.append((input_ids.clone(), logits_positions is not None))
+        return run_model(input_ids, logits_positions, attention_mask)
+
+    monkeypatch.setattr(ProtBert, "_run_model", staticmethod(run_model_recorded))
+    return calls
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 64])
+def test_analyze_mutations(protbert_data, batch_size):
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    results_ref = [ProtBert.analyze_mutation(mutation, protbert_data) for mutation in MUTATIONS]
+
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    results = ProtBert.analyze_mutations(MUTATIONS, protbert_data, batch_size=batch_size)
+
+    assert_results_match(results, results_ref)
+
+    for invalid_mutation in ["S0A", f"G{len(PROTEIN_SEQUENCE) + 1}A"]:
+        with pytest.raises(ProtBertAnalyzeError):
+            ProtBert.analyze_mutations(
+                MUTATIONS + [invalid_mutation], protbert_data, batch_size=batch_size
+            )
+
+
+@pytest.mark.parametrize(
+    "window_size, ligand_window_size", [(None, None), (16, None), (None, 3), (16, 3)]
+)
+def test_analyze_mutations_ligand(window_size, ligand_window_size):
+    if not ProtBert.is_loaded:
+        ProtBert.load_model()
+    data = ProtBert.build(
+        PROTEIN_SEQUENCE,
+        "EYLGLDVPV",
+        window_size=window_size,
+        ligand_window_size=ligand_window_size,
+    )
+    # Only residues of the protein can be mutated
+    ligand_mutation = f"E{len(PROTEIN_SEQUENCE) + 1}A"
+    with pytest.raises(ProtBertAnalyzeError):
+        ProtBert.analyze_mutations([ligand_mutation], data)
+    with ProtBertBatchScheduler() as scheduler:
+        future = scheduler.submit(ligand_mutation, data)
+    with pytest.raises(ProtBertAnalyzeError):
+        future.result()
+
+
+def test_shared_backbone(protbert_data):
+    from transformers import BertModel
+
+    # Features used to be calculated by a separate `BertModel`, loaded next to the masked
+    # language model
+    with importlib_resources.path(elaspic2.plugins.protbert.data, "prot_bert_bfd") as data_dir:
+        bert_model = BertModel.from_pretrained(data_dir.as_posix()).eval()
+    input_ids = ProtBert._get_tokenizer().encode([list(protbert_data.sequence)])
+    with torch.no_grad():
+        output_wt = bert_model(input_ids=input_ids)[0][0].numpy()
+
+    ProtBert.wt_features_cache.clear()
+    result = ProtBert.analyze_mutation("E4L", protbert_data)
+    np.testing.assert_allclose(result["features_residue_wt"], output_wt[3], rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(
+        result["features_protein_wt"], output_wt.mean(axis=0), rtol=1e-4, atol=1e-5
+    )
+
+
+def test_score_outside_top_k(protbert_data, monkeypatch):
+    ProtBert.score_cache.clear()
+    result_ref = ProtBert.analyze_mutation("E4L", protbert_data)
+
+    # Push the mutant residue to the bottom of the ranking. Scores used to be read from the top
+    # 30 predictions of a fill-mask pipeline, which raised `StopIteration` in this case.
+    mut_token_id = ProtBert._get_tokenizer().convert_tokens_to_ids("L")
+    run_model = ProtBert._run_model
+
+    def run_model_demoted(*args, **kwargs):
+        hidden_states, logits = run_model(*args, **kwargs)
+        if logits is not None:
+            # Outputs are inference tensors, which can not be modified in place
+            logits = logits.clone()
+            logits[..., mut_token_id] -= 30
+        return hidden_states, logits
+
+    monkeypatch.setattr(ProtBert, "_run_model", staticmethod(run_model_demoted))
+    ProtBert.score_cache.clear()
+    result = ProtBert.analyze_mutation("E4L", protbert_data)
+    ProtBert.score_cache.clear()
+
+    assert np.isfinite(result["score_mut"])
+    assert 0 < result["score_mut"] < result_ref["score_mut"]
+    assert result["score_wt"] >= result_ref["score_wt"]
+
+
+def test_run_model_logits_positions(protbert_data):
+    input_ids = ProtBert._get_input_ids(protbert_data.sequence).repeat(2, 1)
+    logits_positions = torch.tensor([1, 5])
+    hidden_states, logits = ProtBert._run_model(input_ids, logits_positions=logits_positions)
+
+    # The language model head is applied only at the requested positions
+    with torch.no_grad():
+        logits_ref = ProtBert.backend.lm_head(hidden_states)[[0, 1], logits_positions]
+    assert logits.shape == logits_ref.shape
+    np.testing.assert_allclose(logits.numpy(), logits_ref.numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_score_cache_hits(protbert_data, model_calls):
+    ProtBert.score_cache.clear()
+    results_ref = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+    assert any(output_logits for _, output_logits in model_calls)
+
+    # Every masked position is cached, so scores require no further forward passes
+    model_calls.clear()
+    results = ProtBert.analyze_mutations(MUTATIONS[::-1], protbert_data)
+    assert not any(output_logits for _, output_logits in model_calls)
+    assert_results_match(results, results_ref[::-1])
+
+
+def test_wt_features_cache_hits(protbert_data, model_calls):
+    ProtBert.wt_features_cache.clear()
+    results_ref = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+    wt_input_ids = ProtBert._get_input_ids(protbert_data.sequence)
+    assert any(torch.equal(row, wt_input_ids) for input_ids, _ in model_calls for row in input_ids)
+
+    # Wild-type hidden states are cached, so only mutant sequences go through the model
+    model_calls.clear()
+    results = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+    assert model_calls
+    assert not any(
+        torch.equal(row, wt_input_ids) for input_ids, _ in model_calls for row in input_ids
+    )
+    assert_results_match(results, results_ref)
+
+
+def test_torchscript_backend(protbert_data, tmp_path):
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    results_ref = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+
+    model_file = tmp_path.joinpath("prot_bert_bfd.pt")
+    ProtBert.export_model(model_file)
+    try:
+        ProtBert.load_model(backend="torchscript", model_file=model_file)
+        results = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+    finally:
+        ProtBert.load_model()
+
+    assert_results_match(results, results_ref)
+
+
+def test_score_cache():
+    if not ProtBert.is_loaded:
+        ProtBert.load_model()
+    data = ProtBert.build(PROTEIN_SEQUENCE, "EYLGLDVPV", window_size=16)
+
+    ProtBert.score_cache.clear()
+    ProtBert.analyze_mutations(MUTATIONS, data)
+    # Entries are keyed by a digest of the window sequence and are bounded by size in bytes
+    key = ProtBert._get_score_cache_key(get_window(data, 0))
+    assert isinstance(key[0], bytes)
+    probas = ProtBert.score_cache.get(key)
+    assert probas is not None
+    assert ProtBert.score_cache.currsize == len(ProtBert.score_cache) * (
+        probas.nbytes + _SCORE_CACHE_ENTRY_OVERHEAD
+    )
+
+
+@pytest.mark.parametrize("window_size", [1, 2, 7, 16, 95, 200])
+def test_get_window(window_size):
+    ligand_sequence = "EYLGLDVPV"
+    data = ProtBert.build(PROTEIN_SEQUENCE, ligand_sequence, window_size=window_size)
+    windows = []
+    for mut_idx in range(len(PROTEIN_SEQUENCE)):
+        window_sequence, window_idx = get_window(data, mut_idx)
+        assert window_sequence[window_idx] == PROTEIN_SEQUENCE[mut_idx]
+        assert window_sequence.endswith(ligand_sequence)
+        assert len(window_sequence) == min(window_size, len(PROTEIN_SEQUENCE)) + len(
+            ligand_sequence
+        )
+        windows.append(window_sequence)
+    # Windows are placed deterministically, so neighbouring mutations share windows
+    assert len(set(windows)) <= len(PROTEIN_SEQUENCE) // max(window_size // 2, 1) + 1
+
+
+def test_get_window_ligand():
+    ligand_sequence = "EYLGLDVPV"
+    data = ProtBert.build(PROTEIN_SEQUENCE, ligand_sequence, window_size=10, ligand_window_size=3)
+    window_sequence, window_idx = get_window(data, 50)
+    assert window_sequence[window_idx] == PROTEIN_SEQUENCE[50]
+    assert window_sequence.endswith("GLD")
+    assert len(window_sequence) == 13
+
+
+@pytest.mark.parametrize("window_size, ligand_window_size", [(None, None), (10, 3), (200, None)])
+def test_get_window_input_ids(window_size, ligand_window_size):
+    ligand_sequence = "EYLGLDVPV"
+    data = ProtBert.build(
+        PROTEIN_SEQUENCE,
+        ligand_sequence,
+        window_size=window_size,
+        ligand_window_size=ligand_window_size,
+    )
+    tokenizer = ProtBert._get_tokenizer()
+    input_ids = ProtBert._get_input_ids(data.sequence)
+    assert input_ids.tolist() == tokenizer.encode([list(data.sequence)])[0].tolist()
+    for mut_idx in [0, 50, len(PROTEIN_SEQUENCE) - 1]:
+        protein_slice, ligand_slice, _ = ProtBert._get_window_slices(data, mut_idx)
+        window_sequence, _ = get_window(data, mut_idx)
+        input_ids = ProtBert._get_window_input_ids(data, protein_slice, ligand_slice)
+        assert input_ids.tolist() == tokenizer.encode([list(window_sequence)])[0].tolist()
+
+
+@pytest.mark.parametrize("window_size", [None, 16])
+def test_get_window_input_ids_replaced_sequence(window_size):
+    data = ProtBert.build(PROTEIN_SEQUENCE, None, window_size=window_size)
+    mutant_data = data._replace(sequence="A" + PROTEIN_SEQUENCE[1:])
+
+    # Token ids follow the sequence, also when it is replaced after `build`
+    protein_slice, ligand_slice, _ = ProtBert._get_window_slices(data, 0)
+    input_ids = ProtBert._get_window_input_ids(data, protein_slice, ligand_slice)
+    mutant_input_ids = ProtBert._get_window_input_ids(mutant_data, protein_slice, ligand_slice)
+    assert not torch.equal(mutant_input_ids, input_ids)
+    mutant_window_sequence, _ = get_window(mutant_data, 0)
+    tokenizer = ProtBert._get_tokenizer()
+    assert mutant_input_ids.tolist() == tokenizer.encode([list(mutant_window_sequence)])[0].tolist()
+
+
+@pytest.mark.parametrize("batch_size, bucket_width", [(1, 1), (4, 8), (64, 512)])
+def test_batch_scheduler(batch_size, bucket_width):
+    if not ProtBert.is_loaded:
+        ProtBert.load_model()
+    data_list = [
+        ProtBert.build(PROTEIN_SEQUENCE, None),
+        ProtBert.build(PROTEIN_SEQUENCE[:40], None),
+        ProtBert.build(PROTEIN_SEQUENCE, "EYLGLDVPV", window_size=16),
+    ]
+
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    results_ref = [ProtBert.analyze_mutations(MUTATIONS, data) for data in data_list]
+
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    with ProtBertBatchScheduler(batch_size=batch_size, bucket_width=bucket_width) as scheduler:
+        futures = [
+            [scheduler.submit(mutation, data) for mutation in MUTATIONS] for data in data_list
+        ]
+        invalid_futures = [
+            scheduler.submit("G1A", ProtBert.build("A" + PROTEIN_SEQUENCE, None)),
+            scheduler.submit("S0A", data_list[0]),
+            scheduler.submit(f"G{len(PROTEIN_SEQUENCE) + 1}A", data_list[0]),
+        ]
+
+    for data_futures, data_results_ref in zip(futures, results_ref):
+        assert_results_match([future.result() for future in data_futures], data_results_ref)
+    for invalid_future in invalid_futures:
+        with pytest.raises(ProtBertAnalyzeError):
+            invalid_future.result()
+
+
+def test_mmap_weights(protbert_data, assert_parameters_mapped):
+    ProtBert.score_cache.clear()
+    ProtBert.wt_features_cache.clear()
+    results_ref = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+
+    try:
+        ProtBert.load_model(mmap_weights=True)
+        assert_parameters_mapped(ProtBert.model)
+        results = ProtBert.analyze_mutations(MUTATIONS, protbert_data)
+    finally:
+        ProtBert.load_model()
+
+    assert_results_match(results, results_ref)
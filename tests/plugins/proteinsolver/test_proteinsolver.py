@@ -0,0 +1,189 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from kmbio import PDB
+from kmtools import structure_tools
+
+from elaspic2.plugins.proteinsolver import ProteinSolver
+from elaspic2.plugins.proteinsolver.protein_data import (
+    get_atom_coords,
+    get_k_hop_subgraph,
+    get_residue_distances,
+)
+
+TESTS_DIR = Path(__file__).absolute().parent
+
+PROTEIN_STRUCTURE = TESTS_DIR.parent.parent.joinpath("structures", "1MFG.pdb")
+PROTEIN_SEQUENCE = (
+    "GSMEIRVRVEKDPELGFSISGGVGGRGNPFRPDDDGIFVTRVQPEGPASKLLQPGDKIIQANGYSFINIEHGQAVSLLKTFQNTVELII"
+    "VREVSS"
+)
+MUTATIONS = ["G1A", "G1C", "E4L", "E4W", "R6K", "V7A", "F17W", "I36V", "L77P"]
+
+
+@pytest.fixture(scope="module")
+def proteinsolver_data():
+    if not ProteinSolver.is_loaded:
+        ProteinSolver.load_model()
+    return ProteinSolver.build(PROTEIN_STRUCTURE, PROTEIN_SEQUENCE, None)
+
+
+def assert_results_match(results, results_ref):
+    assert len(results) == len(results_ref)
+    for result, result_ref in zip(results, results_ref):
+        assert result.keys() == result_ref.keys()
+        for key in result:
+            np.testing.assert_allclose(result[key], result_ref[key], rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 64])
+def test_analyze_mutations(proteinsolver_data, batch_size):
+    results_ref = [
+        ProteinSolver.analyze_mutation(mutation, proteinsolver_data) for mutation in MUTATIONS
+    ]
+    results = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data, batch_size=batch_size)
+    assert_results_match(results, results_ref)
+
+
+@pytest.mark.parametrize("batch_size", [1, 64])
+def test_analyze_mutations_subgraph(proteinsolver_data, batch_size):
+    # Subgraphs are extracted from the compact, int32 edge index
+    assert proteinsolver_data.edge_index.dtype == torch.int32
+    results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    results = ProteinSolver.analyze_mutations(
+        MUTATIONS, proteinsolver_data, batch_size=batch_size, use_subgraph=True
+    )
+    assert_results_match(results, results_ref)
+
+
+@pytest.mark.parametrize("inference_model", [True, False])
+def test_edge_chunk_size(proteinsolver_data, inference_model):
+    ProteinSolver.load_model(inference_model=inference_model)
+    try:
+        results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+        ProteinSolver.load_model(inference_model=inference_model, edge_chunk_size=1000)
+        results = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    finally:
+        ProteinSolver.load_model()
+    assert_results_match(results, results_ref)
+
+
+@pytest.mark.parametrize("model_config", [{"inference_model": False}, {"script": True}])
+def test_inference_model(proteinsolver_data, model_config):
+    results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    try:
+        ProteinSolver.load_model(**model_config)
+        results = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    finally:
+        ProteinSolver.load_model()
+    assert_results_match(results, results_ref)
+
+
+def test_inference_model_outputs(proteinsolver_data):
+    x, edge_index, edge_attr = proteinsolver_data
+    x = x.clone()
+    x[[0, 3, 50]] = 20
+    # Both models are loaded from the packaged checkpoint
+    outputs = []
+    try:
+        for inference_model in [False, True]:
+            ProteinSolver.load_model(inference_model=inference_model)
+            with torch.no_grad():
+                output = ProteinSolver.model(x, edge_index.long(), edge_attr.float())
+            outputs.append(output.numpy())
+    finally:
+        ProteinSolver.load_model()
+    np.testing.assert_allclose(outputs[1], outputs[0], rtol=1e-4, atol=1e-5)
+
+
+def test_build_compact_data(proteinsolver_data):
+    assert proteinsolver_data.edge_index.dtype == torch.int32
+    assert proteinsolver_data.edge_attr.dtype == torch.float32
+
+    data = ProteinSolver.build(
+        PROTEIN_STRUCTURE, PROTEIN_SEQUENCE, None, edge_attr_dtype=torch.float16
+    )
+    assert data.edge_attr.dtype == torch.float16
+    assert torch.equal(data.edge_index, proteinsolver_data.edge_index)
+    np.testing.assert_allclose(
+        data.edge_attr.float().numpy(), proteinsolver_data.edge_attr.numpy(), rtol=1e-3
+    )
+
+    # Half-precision edge attributes change scores by at most 1e-3
+    results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    results = ProteinSolver.analyze_mutations(MUTATIONS, data)
+    for result, result_ref in zip(results, results_ref):
+        for key in result:
+            assert abs(result[key] - result_ref[key]) < 1e-3
+
+
+def test_analyze_mutation_sets(proteinsolver_data):
+    results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    results = ProteinSolver.analyze_mutation_sets(
+        [[mutation] for mutation in MUTATIONS], proteinsolver_data, batch_size=4
+    )
+    for result, result_ref in zip(results, results_ref):
+        assert result["scores_wt"] == pytest.approx([result_ref["score_wt"]])
+        assert result["scores_mut"] == pytest.approx([result_ref["score_mut"]])
+
+    mutation_sets = [["G1A", "E4L"], ["R6K", "V7A", "F17W"], ["G1C", "L77P"]]
+    results_ref = ProteinSolver.analyze_mutation_sets(mutation_sets, proteinsolver_data)
+    results = ProteinSolver.analyze_mutation_sets(
+        mutation_sets, proteinsolver_data, batch_size=1, use_subgraph=True
+    )
+    assert_results_match(results, results_ref)
+    for result, mutation_set in zip(results, mutation_sets):
+        assert len(result["scores_wt"]) == len(mutation_set)
+        assert result["score_mut"] == pytest.approx(np.prod(result["scores_mut"]))
+
+
+@pytest.mark.parametrize("dtype", [torch.long, torch.int32])
+def test_get_k_hop_subgraph(dtype):
+    # Path graph 0 - 1 - ... - 9, with edges in both directions
+    row = torch.arange(9)
+    edge_index = torch.cat([torch.stack([row, row + 1]), torch.stack([row + 1, row])], dim=1)
+    edge_index = edge_index.to(dtype)
+
+    subset, edge_index_sub, edge_mask, node_idx_sub = get_k_hop_subgraph(5, 2, edge_index, 10)
+    assert edge_index_sub.dtype == torch.long
+    assert subset.tolist() == [3, 4, 5, 6, 7]
+    assert node_idx_sub == 2
+    assert edge_mask.sum().item() == 8
+    assert (subset[edge_index_sub] == edge_index[:, edge_mask]).all()
+
+    # Neighbourhood is expanded in the direction in which messages are passed
+    subset, _, edge_mask, _ = get_k_hop_subgraph(5, 2, edge_index[:, :9], 10)
+    assert subset.tolist() == [5, 6, 7]
+    assert edge_mask.sum().item() == 2
+
+
+def test_get_residue_distances():
+    structure = PDB.load(PROTEIN_STRUCTURE)
+    distances_ref = structure_tools.get_distances(structure.to_dataframe(), 12, groupby="residue")
+    distances_ref = (
+        distances_ref[distances_ref["residue_idx_1"] != distances_ref["residue_idx_2"]]
+        .sort_values(["residue_idx_1", "residue_idx_2"])
+        .reset_index(drop=True)
+    )
+
+    atom_coords, atom_residue_idxs = get_atom_coords(structure)
+    distances = get_residue_distances(atom_coords, atom_residue_idxs, 12, chunk_size=500)
+
+    assert (distances["residue_idx_1"].values == distances_ref["residue_idx_1"].values).all()
+    assert (distances["residue_idx_2"].values == distances_ref["residue_idx_2"].values).all()
+    np.testing.assert_allclose(distances["distance"].values, distances_ref["distance"].values)
+
+
+@pytest.mark.parametrize("inference_model", [True, False])
+def test_mmap_weights(proteinsolver_data, inference_model, assert_parameters_mapped):
+    ProteinSolver.load_model(inference_model=inference_model)
+    try:
+        results_ref = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+        ProteinSolver.load_model(inference_model=inference_model, mmap_weights=True)
+        assert_parameters_mapped(ProteinSolver.model)
+        results = ProteinSolver.analyze_mutations(MUTATIONS, proteinsolver_data)
+    finally:
+        ProteinSolver.load_model()
+    assert_results_match(results, results_ref)
@@ -0,0 +1,248 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+import elaspic2 as el2
+from elaspic2.plugins.protbert import ProtBert
+from elaspic2.plugins.protbert.protbert import _is_bf16_matmul_supported
+from elaspic2.types import COI
+
+TESTS_DIR = Path(__file__).absolute().parent
+
+PROTEIN_STRUCTURE = TESTS_DIR.joinpath("structures", "1MFG.pdb")
+PROTEIN_SEQUENCE = (
+    "GSMEIRVRVEKDPELGFSISGGVGGRGNPFRPDDDGIFVTRVQPEGPASKLLQPGDKIIQANGYSFINIEHGQAVSLLKTFQNTVELII"
+    "VREVSS"
+)
+MUTATIONS = ["G1A", "G1C", "E4L", "R6K", "V7A", "F17W", "I36V", "L77P"]
+
+# Maximum absolute difference from full precision that we are willing to accept
+PRECISION_TOLERANCES = {
+    "bf16": {"score": 0.05, "el2core": 0.25},
+    "int8": {"score": 0.05, "el2core": 0.25},
+}
+
+
+@pytest.fixture(scope="module")
+def model():
+    return el2.ELASPIC2()
+
+
+def predict_stability(model):
+    protein_features = model.build(
+        structure_file=PROTEIN_STRUCTURE,
+        protein_sequence=PROTEIN_SEQUENCE,
+        ligand_sequence=None,
+    )
+    mutation_features = [
+        model.analyze_mutation(mutation, protein_features) for mutation in MUTATIONS
+    ]
+    el2core = model.predict_mutation_effect(mutation_features)
+    return mutation_features, el2core
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_analyze_mutations(model, batch_size):
+    protein_features = model.build(
+        structure_file=PROTEIN_STRUCTURE,
+        protein_sequence=PROTEIN_SEQUENCE,
+        ligand_sequence=None,
+    )
+    results_ref = [model.analyze_mutation(mutation, protein_features) for mutation in MUTATIONS]
+    results = model.analyze_mutations(MUTATIONS, protein_features, batch_size=batch_size)
+    assert len(results) == len(results_ref)
+    for result, result_ref in zip(results, results_ref):
+        assert result.keys() == result_ref.keys()
+        for key in result:
+            np.testing.assert_allclose(result[key], result_ref[key], rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "precision",
+    [
+        pytest.param(
+            "bf16",
+            marks=pytest.mark.skipif(
+                not _is_bf16_matmul_supported(torch.device("cpu")),
+                reason="bfloat16 matrix multiplications are not supported on CPU",
+            ),
+        ),
+        "int8",
+    ],
+)
+def test_protbert_precision(model, precision):
+    tolerances = PRECISION_TOLERANCES[precision]
+
+    ProtBert.load_model(precision="fp32")
+    features_ref, el2core_ref = predict_stability(model)
+    try:
+        ProtBert.load_model(precision=precision)
+        features, el2core = predict_stability(model)
+    finally:
+        ProtBert.load_model(precision="fp32")
+
+    for key in ["protbert_core_score_wt", "protbert_core_score_mut"]:
+        values = np.array([f[key] for f in features])
+        values_ref = np.array([f[key] for f in features_ref])
+        assert np.abs(values - values_ref).max() < tolerances["score"], key
+    assert np.abs(el2core - el2core_ref).max() < tolerances["el2core"]
+
+
+@pytest.mark.parametrize("coi", list(COI))
+def test_load_models(coi):
+    lgb_models = el2.ELASPIC2._load_lgb_models(coi)
+    assert len(lgb_models) == 6
+    lgb_ensemble = el2.ELASPIC2._load_lgb_ensemble(coi)
+    for lgb_model in lgb_models:
+        assert lgb_model.feature_name() == lgb_ensemble.feature_names
+    # Models are loaded only once per process
+    assert el2.ELASPIC2._load_lgb_models(coi) is lgb_models
+    assert el2.ELASPIC2._load_pca_models(coi) is el2.ELASPIC2._load_pca_models(coi)
+
+
+@pytest.mark.parametrize("coi", list(COI))
+def test_pca_projection(coi):
+    pca_models = el2.ELASPIC2._load_pca_models(coi)
+    projection = el2.ELASPIC2._load_pca_projection(coi)
+    assert projection.columns
+
+    rng = np.random.default_rng(42)
+    arrays = {}
+    for column in projection.columns:
+        pca_model = pca_models[f"pca-{column}-{coi.value}"]
+        noise = rng.normal(size=(64, len(pca_model.mean_)))
+        arrays[column] = (pca_model.mean_ + noise).astype(np.float32)
+    pca_features = projection.transform(arrays)
+
+    # Projections are centered after, rather than before, the matrix product, so they match
+    # `PCA.transform` up to rounding errors in double precision
+    for column, output_columns in zip(projection.columns, projection.output_columns):
+        values_ref = pca_models[f"pca-{column}-{coi.value}"].transform(
+            arrays[column].astype(np.float64)
+        )
+        for output_column in output_columns:
+            component_idx = int(output_column[len(column) + 1 : -len("_pc")])
+            np.testing.assert_allclose(
+                pca_features[output_column], values_ref[:, component_idx], rtol=1e-9, atol=1e-9
+            )
+
+
+def test_mmap_weights_already_loaded(model):
+    with pytest.warns(UserWarning, match="mmap_weights"):
+        el2.ELASPIC2(mmap_weights=True)
+
+
+def make_random_features(num_mutations, coi, seed):
+    rng = np.random.default_rng(seed)
+    features = []
+    for _ in range(num_mutations):
+        mutation_features = {}
+        for plugin in ["protbert", "proteinsolver"]:
+            for key in ["score_wt", "score_mut"]:
+                # Scores are float32 probabilities
+                mutation_features[f"{plugin}_{coi.value}_{key}"] = float(np.float32(rng.random()))
+        for key in ["residue", "protein"]:
+            embedding_wt = rng.normal(size=1024).astype(np.float32)
+            embedding_mut = embedding_wt + rng.normal(scale=0.1, size=1024).astype(np.float32)
+            mutation_features[f"protbert_{coi.value}_features_{key}_wt"] = embedding_wt
+            mutation_features[f"protbert_{coi.value}_features_{key}_mut"] = embedding_mut
+        features.append(mutation_features)
+    return features
+
+
+def test_predict_mutation_effect_chunks(model):
+    stability_features = make_random_features(50, COI.CORE, 0)
+    affinity_features = make_random_features(50, COI.INTERFACE, 1)
+
+    el2core = model.predict_mutation_effect(stability_features)
+    el2core_chunks = list(
+        model.predict_mutation_effect_chunks(iter(stability_features), chunk_size=16)
+    )
+    assert [len(chunk) for chunk in el2core_chunks] == [16, 16, 16, 2]
+    assert np.array_equal(np.concatenate(el2core_chunks), el2core)
+
+    el2interface = model.predict_mutation_effect(stability_features, affinity_features)
+    el2interface_chunks = list(
+        model.predict_mutation_effect_chunks(
+            iter(stability_features), iter(affinity_features), chunk_size=16
+        )
+    )
+    assert np.array_equal(np.concatenate(el2interface_chunks), el2interface)
+
+
+def predict_mutation_effect_ref(mutation_stability_features, mutation_affinity_features=None):
+    """Predict mutation effects using DataFrames and `lgb.Booster.predict`, as ELASPIC2 used to."""
+    coi = COI.INTERFACE if mutation_affinity_features is not None else COI.CORE
+    pca_models = el2.ELASPIC2._load_pca_models(coi)
+    lgb_models = el2.ELASPIC2._load_lgb_models(coi)
+    feature_columns = lgb_models[0].feature_name()
+
+    mutation_features = mutation_stability_features
+    if mutation_affinity_features is not None:
+        mutation_features = [
+            {**stability_features, **affinity_features}
+            for stability_features, affinity_features in zip(
+                mutation_stability_features, mutation_affinity_features
+            )
+        ]
+    # Embeddings used to be returned as lists of Python floats
+    mutation_features = [
+        {
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in features.items()
+        }
+        for features in mutation_features
+    ]
+
+    df = pd.DataFrame(mutation_features)
+    pca_columns = []
+    delta_columns = [
+        (column, column[:-4] + "_wt", column[:-4] + "_change")
+        for column in sorted(df)
+        if column.endswith("_mut") and "_core2interface_" not in column
+    ]
+    for column, column_ref, column_change in delta_columns:
+        if isinstance(df[column].iloc[0], (list, np.ndarray)):
+            df[column_change] = df[column].apply(np.array) - df[column_ref].apply(np.array)
+            pca_columns.extend([column_ref, column_change])
+        else:
+            df[column_change] = df[column] - df[column_ref]
+    delta_columns = [
+        (column, column.replace("_interface_", "_core_"))
+        for column in sorted(df)
+        if "_interface_" in column and not column.endswith("_mut")
+    ]
+    for column, column_ref in delta_columns:
+        column_change = column.replace("_interface_", "_core2interface_")
+        if isinstance(df[column].iloc[0], (list, np.ndarray)):
+            df[column_change] = df[column].apply(np.array) - df[column_ref].apply(np.array)
+            pca_columns.append(column_change)
+        else:
+            df[column_change] = df[column] - df[column_ref]
+
+    for column in pca_columns:
+        values_out = pca_models[f"pca-{column}-{coi.value}"].transform(np.vstack(df[column].values))
+        for i in range(10):
+            df[f"{column}_{i}_pc"] = values_out[:, i]
+    return np.mean([lgb_model.predict(df[feature_columns]) for lgb_model in lgb_models], axis=0)
+
+
+def test_predict_mutation_effect_ref(model):
+    stability_features = make_random_features(50, COI.CORE, 0)
+    affinity_features = make_random_features(50, COI.INTERFACE, 1)
+    # Keys that are not used by the models are ignored
+    for features in stability_features + affinity_features:
+        features["mutation"] = "G1A"
+
+    # Only the PCA projections are calculated differently, and their rounding errors are too
+    # small to move any feature across a LightGBM threshold
+    el2core = model.predict_mutation_effect(stability_features)
+    el2core_ref = predict_mutation_effect_ref(stability_features)
+    np.testing.assert_allclose(el2core, el2core_ref, rtol=0, atol=1e-9)
+
+    el2interface = model.predict_mutation_effect(stability_features, affinity_features)
+    el2interface_ref = predict_mutation_effect_ref(stability_features, affinity_features)
+    np.testing.assert_allclose(el2interface, el2interface_ref, rtol=0, atol=1e-9)
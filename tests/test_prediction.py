@@ -0,0 +1,194 @@
+import tracemalloc
+
+import lightgbm as lgb
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+
+from elaspic2.prediction import (
+    FeatureColumns,
+    FeatureDeltaPlan,
+    LightGBMEnsemble,
+    LightGBMEnsembleError,
+    PCAProjection,
+)
+
+
+def test_pca_projection():
+    rng = np.random.default_rng(42)
+    pca_models = {
+        column: PCA(n_components=10).fit(rng.normal(size=(50, 32))) for column in ["a", "b", "c"]
+    }
+    feature_columns = ["score", "a_0_pc", "a_7_pc", "b_3_pc"]
+    projection = PCAProjection(pca_models, feature_columns)
+    assert projection.columns == ["a", "b"]
+
+    arrays = {column: rng.normal(size=(20, 32)) for column in pca_models}
+    pca_features = projection.transform(arrays)
+    assert list(pca_features) == feature_columns[1:]
+    for column in pca_features:
+        pca_column, component_idx, _ = column.split("_")
+        values_ref = pca_models[pca_column].transform(arrays[pca_column])[:, int(component_idx)]
+        assert np.allclose(pca_features[column], values_ref)
+
+
+def test_pca_projection_memory():
+    rng = np.random.default_rng(42)
+    columns = ["a", "b", "c", "d"]
+    pca_models = {
+        column: PCA(n_components=10).fit(rng.normal(size=(50, 256))) for column in columns
+    }
+    projection = PCAProjection(pca_models, [f"{column}_0_pc" for column in columns])
+
+    arrays = {column: rng.normal(size=(2000, 256)).astype(np.float32) for column in columns}
+    tracemalloc.start()
+    try:
+        pca_features = projection.transform(arrays)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert all(values.dtype == np.float64 for values in pca_features.values())
+    # Only one column at a time is converted to double precision, and columns are not stacked
+    assert peak_memory < 3 * arrays["a"].nbytes
+
+
+def test_feature_columns():
+    records = [
+        {"score": 0.5, "features": np.arange(4, dtype=np.float32)},
+        {"score": 0.25, "features": [1.0, 2.0, 3.0, 4.0]},
+    ]
+    features = FeatureColumns.from_records(records)
+    assert features.num_rows == 2
+    assert features["score"].dtype == np.float32 and features["score"].shape == (2,)
+    assert features["features"].dtype == np.float32 and features["features"].shape == (2, 4)
+    assert features["features"].flags.c_contiguous
+
+    matrix = features.to_matrix(["score", "score"])
+    assert matrix.dtype == np.float32
+    assert np.array_equal(matrix, [[0.5, 0.5], [0.25, 0.25]])
+    assert features.to_matrix(["score"], dtype=np.float64).dtype == np.float64
+
+    # Keys which are not requested do not have to be numeric
+    records = [{**record, "mutation": mutation} for record, mutation in zip(records, "AB")]
+    features = FeatureColumns.from_records(records, {"score", "other"})
+    assert list(features) == ["score"]
+
+
+def test_feature_delta_plan():
+    plan = FeatureDeltaPlan(["x_core_score_change", "x_core2interface_score_change", "x_core_pc"])
+    assert [delta[0] for delta in plan.deltas] == [
+        "x_core_score_change",
+        "x_interface_score_change",
+        "x_core2interface_score_change",
+    ]
+
+    features = FeatureColumns(
+        {
+            "x_core_score_wt": np.array([1.0, 2.0], dtype=np.float32),
+            "x_core_score_mut": np.array([0.5, 3.0], dtype=np.float32),
+            "x_interface_score_wt": np.array([2.0, 2.0], dtype=np.float32),
+            "x_interface_score_mut": np.array([1.0, 1.0], dtype=np.float32),
+        }
+    )
+    assert plan.input_columns == [
+        "x_core_score_mut",
+        "x_core_score_wt",
+        "x_interface_score_mut",
+        "x_interface_score_wt",
+        "x_core_pc",
+    ]
+
+    features_out = plan.apply(features)
+    assert "x_core_score_change" not in features
+    assert features_out["x_core_score_change"].dtype == np.float64
+    assert np.array_equal(features_out["x_core_score_change"], [-0.5, 1.0])
+    assert np.array_equal(features_out["x_core2interface_score_change"], [-0.5, -2.0])
+
+
+@pytest.mark.parametrize(
+    "params",
+    [{}, {"use_missing": False}, {"zero_as_missing": True}],
+)
+def test_lightgbm_ensemble(params):
+    rng = np.random.default_rng(42)
+    x = rng.normal(size=(500, 4))
+    x[rng.random(x.shape) < 0.1] = np.nan
+    x[rng.random(x.shape) < 0.1] = 0
+    y = np.nan_to_num(x[:, 0]) + rng.normal(scale=0.1, size=len(x))
+    lgb_models = [
+        lgb.train(
+            {"num_leaves": 8, "min_data_in_leaf": 5, "seed": seed, "verbose": -1, **params},
+            lgb.Dataset(x, y),
+            num_boost_round=10,
+        )
+        for seed in range(3)
+    ]
+
+    x_test = rng.normal(size=(300, 4)).astype(np.float32)
+    x_test[rng.random(x_test.shape) < 0.1] = np.nan
+    x_test[rng.random(x_test.shape) < 0.1] = 0
+    predictions_ref = np.mean([lgb_model.predict(x_test) for lgb_model in lgb_models], axis=0)
+    predictions = LightGBMEnsemble(lgb_models, chunk_size=64).predict(x_test)
+    assert np.array_equal(predictions, predictions_ref)
+
+
+@pytest.mark.parametrize("params", [{}, {"zero_as_missing": True}])
+def test_lightgbm_ensemble_zero_threshold(params):
+    rng = np.random.default_rng(42)
+    x = rng.normal(size=(500, 2))
+    x[rng.random(x.shape) < 0.2] = 0
+    y = np.sign(x[:, 0]) + rng.normal(scale=0.1, size=len(x))
+    lgb_models = [
+        lgb.train(
+            {"num_leaves": 8, "min_data_in_leaf": 5, "seed": seed, "verbose": -1, **params},
+            lgb.Dataset(x, y),
+            num_boost_round=10,
+        )
+        for seed in range(3)
+    ]
+    lgb_ensemble = LightGBMEnsemble(lgb_models)
+    thresholds = lgb_ensemble.threshold[~lgb_ensemble.is_leaf]
+    # Splits around zero use thresholds of +/- `_ZERO_THRESHOLD`, rounded to single precision
+    assert np.isclose(np.abs(thresholds), 1e-35, rtol=1e-6, atol=0).any()
+
+    # Features equal to, or just around, the thresholds and the zero threshold
+    values = np.r_[thresholds, 0.0, 1e-36, 1e-35, 1.0000000180025095e-35]
+    values = np.r_[values, -values]
+    values = np.unique(np.r_[values, np.nextafter(values, -np.inf), np.nextafter(values, np.inf)])
+    x_test = rng.choice(values, size=(1000, 2))
+    predictions_ref = np.mean([lgb_model.predict(x_test) for lgb_model in lgb_models], axis=0)
+    predictions = lgb_ensemble.predict(x_test)
+    assert np.array_equal(predictions, predictions_ref)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"objective": "binary"},
+        {"objective": "poisson"},
+        {"objective": "regression", "reg_sqrt": True},
+        {"objective": "multiclass", "num_class": 3},
+        {"boosting": "rf", "bagging_freq": 1, "bagging_fraction": 0.5},
+    ],
+)
+def test_lightgbm_ensemble_unsupported(params):
+    rng = np.random.default_rng(42)
+    x = rng.normal(size=(200, 4))
+    y = (x[:, 0] > 0).astype(float)
+    if params.get("objective") == "multiclass":
+        y += x[:, 1] > 0
+    lgb_model = lgb.train(
+        {"num_leaves": 8, "verbose": -1, **params}, lgb.Dataset(x, y), num_boost_round=5
+    )
+    with pytest.raises(LightGBMEnsembleError):
+        LightGBMEnsemble([lgb_model])
+
+
+def test_feature_columns_iter_chunks():
+    records = [{"score": float(i)} for i in range(5)]
+    feature_columns = FeatureColumns.from_records(records[:2])
+    chunks = list(FeatureColumns.iter_chunks(records[:3] + [feature_columns] + records[3:], 2))
+    assert [chunk.num_rows for chunk in chunks] == [2, 1, 2, 2]
+    assert chunks[2] is feature_columns
+    assert np.array_equal(chunks[3]["score"], [3.0, 4.0])